@@ -0,0 +1,432 @@
+"""Python client for the UDITA bridge, sync and asyncio.
+
+    from client import Bridge
+    b=Bridge("http://localhost:5050")
+    with b.lease(caps={"ios":"17"},wait=60) as d:
+        d.tap(100,200)
+        print(d.battery().percentage,d.find("Settings")[0].rect().center)
+    b.map(lambda d:d.screenshot_png(),concurrency=8)  # whole fleet, 8 at a time
+
+    from client import AsyncBridge
+    async with AsyncBridge() as b:
+        await asyncio.gather(b.device(ip1).home(),b.device(ip2).home())
+        await b.map(run_smoke_test,concurrency=4)
+
+Every method on Device mirrors one /api/* route and every method on Element
+one /api/element/<eid>/* route; keyword arguments become the JSON body (query
+string for GETs). Requests share one keep-alive connection pool per Bridge.
+"""
+
+import asyncio,base64,time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import requests
+from requests.adapters import HTTPAdapter
+
+class BridgeError(Exception):
+    """The bridge answered with an HTTP error, or a typed call got an error body."""
+    def __init__(self,message,status=None,body=None):
+        super().__init__(message);self.status=status;self.body=body
+
+# ── Typed results ────────────────────────────────────────────────────────────
+
+@dataclass(frozen=True)
+class Rect:
+    x:float
+    y:float
+    width:float
+    height:float
+
+    @property
+    def center(self):return (self.x+self.width/2,self.y+self.height/2)
+
+    @classmethod
+    def from_response(cls,r):
+        v=_value(r)
+        if not isinstance(v,dict) or "width" not in v:raise BridgeError("no rect in response",body=r)
+        return cls(v.get("x",0),v.get("y",0),v["width"],v["height"])
+
+@dataclass(frozen=True)
+class Battery:
+    level:float  # 0.0–1.0 as reported by UIDevice.batteryLevel
+    state:int  # UIDeviceBatteryState: 0 unknown, 1 unplugged, 2 charging, 3 full
+    percentage:int
+
+    @property
+    def charging(self):return self.state in (2,3)
+
+    @classmethod
+    def from_response(cls,r):
+        v=_value(r)
+        if not isinstance(v,dict) or v.get("level") is None:raise BridgeError("no battery level in response",body=r)
+        level=float(v["level"])
+        pct=r.get("percentage",v.get("percentage"))  # r_batt adds it; same rounding if an old bridge did not
+        if pct is None:pct=min(100,max(0,int(round(level*100 if level<=1 else level))))
+        return cls(level,int(v.get("state") or 0),int(pct))
+
+@dataclass(frozen=True)
+class Lease:
+    id:str
+    ip:str
+    client:str
+    ttl:float
+    expires:float
+
+    @classmethod
+    def from_response(cls,l):return cls(l["id"],l["ip"],l.get("client") or "",l.get("ttl",0),l.get("expires",0))
+
+def _template_body(name,image,rect,device):
+    return {"name":name,"image":base64.b64encode(image).decode() if image else None,"rect":rect,"device":device}
+
+def _value(r):
+    if not isinstance(r,dict):raise BridgeError("unexpected response",body=r)
+    if r.get("error"):raise BridgeError(str(r["error"]),body=r)
+    return r.get("value",r)
+
+# ── Route tables ─────────────────────────────────────────────────────────────
+# name -> (HTTP method, path, positional argument names)
+
+DEVICE_ROUTES={
+    "status":("GET","/api/status",()),
+    "screenshot":("GET","/api/screenshot",()),
+    "source":("GET","/api/source",()),
+    "accessible_source":("GET","/api/accessible-source",()),
+    "elements":("GET","/api/elements",()),
+    "device_info":("GET","/api/device-info",()),
+    "active_app":("GET","/api/active-app",()),
+    "screen_info":("GET","/api/screen-info",()),
+    "locked":("GET","/api/locked",()),
+    "orientation":("GET","/api/orientation",()),
+    "set_orientation":("POST","/api/orientation",("orientation",)),
+    "rotation":("GET","/api/rotation",()),
+    "set_rotation":("POST","/api/rotation",()),
+    "window_rect":("GET","/api/window-rect",()),
+    "healthcheck":("GET","/api/healthcheck",()),
+    "tap":("POST","/api/tap",("x","y")),
+    "double_tap":("POST","/api/double-tap",("x","y")),
+    "long_press":("POST","/api/long-press",("x","y","duration")),
+    "drag":("POST","/api/drag",("fromX","fromY","toX","toY","duration")),
+    "pinch":("POST","/api/pinch",("scale","velocity")),
+    "rotate":("POST","/api/rotate",("rotation","velocity")),
+    "scroll":("POST","/api/scroll",("direction",)),
+    "two_finger_tap":("POST","/api/two-finger-tap",("x","y")),
+    "multi_tap":("POST","/api/multi-tap",("x","y","taps","touches")),
+    "force_touch":("POST","/api/force-touch",("x","y","pressure","duration")),
+    "actions":("POST","/api/actions",("actions",)),
+    "press_drag_velocity":("POST","/api/press-drag-velocity",()),
+    "home":("POST","/api/home",()),
+    "homescreen":("POST","/api/homescreen",()),
+    "press_button":("POST","/api/press-button",("name",)),
+    "lock":("POST","/api/lock",()),
+    "unlock":("POST","/api/unlock",()),
+    "type_text":("POST","/api/type",("text",)),
+    "dismiss_keyboard":("POST","/api/dismiss-keyboard",()),
+    "get_clipboard":("POST","/api/clipboard/get",("contentType",)),
+    "set_clipboard":("POST","/api/clipboard/set",("content","contentType")),
+    "alert":("GET","/api/alert",()),
+    "alert_buttons":("GET","/api/alert/buttons",()),
+    "alert_accept":("POST","/api/alert/accept",()),
+    "alert_dismiss":("POST","/api/alert/dismiss",()),
+    "set_alert_text":("POST","/api/alert/text",("value",)),
+    "launch":("POST","/api/launch",("bundle_id",)),
+    "launch_unattached":("POST","/api/launch-unattached",("bundleId",)),
+    "activate":("POST","/api/activate",("bundle_id",)),
+    "terminate":("POST","/api/terminate",("bundle_id",)),
+    "app_state":("POST","/api/app-state",("bundle_id",)),
+    "app_list":("GET","/api/app-list",()),
+    "deactivate_app":("POST","/api/deactivate-app",("duration",)),
+    "open_url":("POST","/api/open-url",("url",)),
+    "reset_app_auth":("POST","/api/reset-app-auth",("resource",)),
+    "click":("POST","/api/click",("name",)),
+    "active_element":("GET","/api/active-element",()),
+    "answer_call":("POST","/api/answer-call",()),
+    "decline_call":("POST","/api/decline-call",()),
+    "wait_stable":("POST","/api/wait-stable",()),
+    "wait_for":("POST","/api/wait-for",("name",)),
+    "find_image":("POST","/api/find-image",("template","threshold")),
+    "tap_image":("POST","/api/tap-image",("template","threshold")),
+    "siri":("POST","/api/siri",("text",)),
+    "appearance":("POST","/api/appearance",("name",)),
+    "location":("GET","/api/location",()),
+    "simulated_location":("GET","/api/simulated-location",()),
+    "set_simulated_location":("POST","/api/simulated-location",("latitude","longitude")),
+    "clear_simulated_location":("DELETE","/api/simulated-location",()),
+    "video":("GET","/api/video",()),
+    "video_start":("POST","/api/video/start",()),
+    "video_stop":("POST","/api/video/stop",()),
+    "picker_select":("POST","/api/picker-select",("element_id",)),
+    "settings":("GET","/api/settings",()),
+    "set_settings":("POST","/api/settings",("settings",)),
+    "accessibility_audit":("POST","/api/accessibility-audit",()),
+    "expect_notification":("POST","/api/expect-notification",("name",)),
+    "touch_id":("POST","/api/touch-id",("match",)),
+    "timeouts":("POST","/api/timeouts",()),
+}
+
+ELEMENT_ROUTES={  # paths are relative to /api/element/<eid>
+    "enabled":("GET","/enabled",()),
+    "text":("GET","/text",()),
+    "displayed":("GET","/displayed",()),
+    "selected":("GET","/selected",()),
+    "name":("GET","/name",()),
+    "accessible":("GET","/accessible",()),
+    "accessibility_container":("GET","/accessibility-container",()),
+    "visible_cells":("GET","/visible-cells",()),
+    "set_value":("POST","/value",("value",)),
+    "click":("POST","/click",()),
+    "clear":("POST","/clear",()),
+    "scroll_to":("POST","/scroll-to",()),
+    "swipe":("POST","/swipe",("direction",)),
+    "pinch":("POST","/pinch",("scale","velocity")),
+    "tap":("POST","/tap",("x","y")),
+    "double_tap":("POST","/double-tap",()),
+    "two_finger_tap":("POST","/two-finger-tap",()),
+    "touch_and_hold":("POST","/touch-and-hold",("duration",)),
+    "force_touch":("POST","/force-touch",("pressure","duration")),
+    "rotate":("POST","/rotate",("rotation","velocity")),
+    "scroll":("POST","/scroll",("direction",)),
+    "drag":("POST","/drag",("fromX","fromY","toX","toY","duration")),
+    "press_drag_velocity":("POST","/press-drag-velocity",()),
+    "keyboard_input":("POST","/keyboard-input",("value",)),
+    "multi_tap":("POST","/multi-tap",("numberOfTaps","numberOfTouches")),
+}
+
+FLEET_ROUTES={  # on Bridge / AsyncBridge
+    "leases":("GET","/api/leases",()),
+    "templates":("GET","/api/templates",()),
+    "scan_now":("POST","/api/scan-now",()),
+    "select":("POST","/api/device/select",("ip",)),
+    "ping":("GET","/api/ping",()),
+    "breakers":("GET","/api/breakers",()),
+    "shards":("GET","/api/shards",()),
+    "events":("GET","/api/events",()),
+    "clear_events":("POST","/api/events/clear",()),
+}
+
+def _route_method(name,method,path,argnames):
+    def call(self,*args,**kw):
+        if len(args)>len(argnames):raise TypeError(f"{name}() takes at most {len(argnames)} positional arguments")
+        kw.update(zip(argnames,args))
+        return self._call(method,self._path+path,kw)
+    call.__name__=name;call.__doc__=f"{method} {path}"
+    return call
+
+# ── Handles (shared by the sync and asyncio clients) ─────────────────────────
+# A handle only builds requests; its Bridge decides whether _call returns the
+# result or an awaitable of it, and applies the typed conversion.
+
+class Element:
+    def __init__(self,device,eid):
+        self.device=device;self.id=eid;self._path=f"/api/element/{eid}"
+
+    def __repr__(self):return f"Element({self.id!r})"
+
+    def _call(self,method,path,body=None,conv=None,raw=False):
+        return self.device._call(method,path,body,conv=conv,raw=raw)
+
+    def rect(self):return self._call("GET",self._path+"/rect",conv=Rect.from_response)
+    def attribute(self,name):return self._call("GET",f"{self._path}/attribute/{name}")
+    def screenshot_png(self):return self._call("GET",self._path+"/screenshot",raw=True)
+    def find_element(self,value,using="name"):
+        return self._call("POST",self._path+"/element",{"using":using,"value":value},conv=self.device._to_element)
+    def find_elements(self,value,using="name"):
+        return self._call("POST",self._path+"/elements",{"using":using,"value":value},conv=self.device._to_elements)
+
+for _n,_r in ELEMENT_ROUTES.items():setattr(Element,_n,_route_method(_n,*_r))
+
+class Device:
+    """One phone, addressed by IP (X-Device) or by a lease (X-Lease). Usable as a (async) context manager for leases."""
+    _path=""
+
+    def __init__(self,bridge,ip=None,lease=None):
+        self.bridge=bridge;self.ip=ip or (lease.ip if lease else None);self.lease=lease
+
+    def __repr__(self):return f"Device({self.ip!r}{', leased' if self.lease else ''})"
+
+    def _headers(self):
+        if self.lease:return {"X-Lease":self.lease.id}
+        return {"X-Device":self.ip} if self.ip else {}
+
+    def _call(self,method,path,body=None,conv=None,raw=False):
+        return self.bridge._call(method,path,body,headers=self._headers(),conv=conv,raw=raw)
+
+    def _to_element(self,r):
+        v=_value(r)
+        eid=(v or {}).get("ELEMENT") if isinstance(v,dict) else None
+        if not eid:raise BridgeError("element not found",body=r)
+        return Element(self,eid)
+
+    def _to_elements(self,r):
+        v=_value(r)
+        return [Element(self,e["ELEMENT"]) for e in (v if isinstance(v,list) else []) if isinstance(e,dict) and e.get("ELEMENT")]
+
+    def element(self,eid):return Element(self,eid)
+    def find(self,value,using="name"):return self._call("POST","/api/find",{"using":using,"value":value},conv=self._to_elements)
+    def battery(self):return self._call("GET","/api/battery",conv=Battery.from_response)
+    def screenshot_png(self):return self._call("GET","/api/screenshot.png",raw=True)
+    def swipe(self,x1,y1,x2,y2,duration=0.5):
+        return self._call("POST","/api/swipe",{"from":{"x":x1,"y":y1},"to":{"x":x2,"y":y2},"duration":duration})
+    def submit(self,name,*args,deadline=None,**kw):
+        """Run a route as a bridge job instead of waiting on it; returns the job (see Bridge.job)."""
+        method,path,argnames=DEVICE_ROUTES[name]
+        kw.update(zip(argnames,args))
+        h=dict(self._headers(),Prefer="respond-async")
+        if deadline is not None:h["X-Deadline"]=str(deadline)
+        return self.bridge._call(method,path,kw,headers=h)
+    def wda(self,method,path,body=None):
+        """Raw WDA call through the /wda passthrough."""
+        return self._call(method,"/wda/"+path.lstrip("/"),body)
+
+    def heartbeat(self):
+        if not self.lease:raise BridgeError("device has no lease")
+        return self.bridge._call("POST",f"/api/lease/{self.lease.id}/heartbeat",conv=Lease.from_response)
+    def release(self):
+        if not self.lease:raise BridgeError("device has no lease")
+        return self.bridge._call("DELETE",f"/api/lease/{self.lease.id}")
+
+    def __enter__(self):
+        if isinstance(self.bridge,AsyncBridge):raise TypeError("use 'async with' for a Device from AsyncBridge")
+        return self
+    def __exit__(self,*exc):
+        if self.lease:
+            try:self.release()
+            except BridgeError:pass  # already expired
+    async def __aenter__(self):return self
+    async def __aexit__(self,*exc):
+        if self.lease:
+            try:await self.release()
+            except BridgeError:pass
+
+for _n,_r in DEVICE_ROUTES.items():setattr(Device,_n,_route_method(_n,*_r))
+
+# ── Fleet calls (shared by the sync and asyncio clients) ─────────────────────
+
+class _Fleet:
+    """Fleet-level routes; the subclass's _call returns the result or an awaitable of it."""
+    _path=""
+
+    def job(self,job_id,wait=0):
+        """Job state; wait (s) long-polls until it finishes. A finished job's JSON response is in "result"."""
+        return self._call("GET",f"/api/jobs/{job_id}",{"wait":wait or None},timeout=wait+self.timeout)
+    def cancel_job(self,job_id):return self._call("DELETE",f"/api/jobs/{job_id}")
+    def add_template(self,name,image=None,rect=None,device=None):
+        """Upload a reference image (PNG/JPEG bytes), or crop rect {x,y,w,h} (points) from a device's screen."""
+        return self._call("POST","/api/templates",_template_body(name,image,rect,device))
+    def delete_template(self,name):return self._call("DELETE",f"/api/templates/{name}")
+    def telemetry(self,device=None,start=None,end=None,resolution="auto"):
+        """Per-device summary, or one device's series (columns keyed by field) between unix times start and end."""
+        return self._call("GET","/api/telemetry",{"device":device,"from":start,"to":end,"resolution":resolution if device else None})
+    def register(self,*ips):return self._call("POST","/api/devices/register",{"devices":[{"ip":ip} for ip in ips]})
+
+for _n,_r in FLEET_ROUTES.items():setattr(_Fleet,_n,_route_method(_n,*_r))
+
+# ── Sync client ──────────────────────────────────────────────────────────────
+
+class Bridge(_Fleet):
+    """Blocking client. Thread-safe; reuses keep-alive connections from one pool.
+    Requests the bridge sheds (429/503 with Retry-After) are retried up to `retries` times: any
+    GET/HEAD, other methods only when the bridge marks them unexecuted (X-Shed)."""
+
+    def __init__(self,url="http://localhost:5050",timeout=60,pool=32,retries=2):
+        self.url=url.rstrip("/");self.timeout=timeout;self.pool=pool;self.retries=retries
+        self.http=requests.Session()
+        ad=HTTPAdapter(pool_connections=4,pool_maxsize=pool)
+        self.http.mount("http://",ad);self.http.mount("https://",ad)
+
+    def close(self):self.http.close()
+    def __enter__(self):return self
+    def __exit__(self,*exc):self.close()
+
+    def _call(self,method,path,body=None,headers=None,conv=None,raw=False,timeout=None):
+        body={k:v for k,v in (body or {}).items() if v is not None}
+        get=method in ("GET","HEAD")
+        for attempt in range(self.retries+1):
+            r=self.http.request(method,self.url+path,params=body if get else None,json=None if get else body,
+                headers=headers,timeout=timeout or self.timeout)
+            if r.status_code not in (429,503) or "Retry-After" not in r.headers or attempt==self.retries:break
+            if not get and r.headers.get("X-Shed")!="1":break  # may have run upstream: a tap or launch must not repeat
+            time.sleep(min(30.0,float(r.headers["Retry-After"])))
+        if r.status_code>=400:
+            try:b=r.json()
+            except ValueError:b=r.text
+            raise BridgeError((b.get("error") if isinstance(b,dict) else None) or f"HTTP {r.status_code}",r.status_code,b)
+        if raw:return r.content
+        out=r.json()
+        return conv(out) if conv else out
+
+    def device(self,ip=None):
+        """Handle for a device by IP; None means whichever device the bridge has selected."""
+        return Device(self,ip)
+
+    def devices(self,reachable=True):
+        ds=self._call("GET","/api/devices").get("devices",[])
+        return [d for d in ds if d.get("status")=="reachable"] if reachable else ds
+
+    def lease(self,caps=None,ttl=None,priority=None,client=None,wait=0):
+        """Acquire a device (see /api/lease) and return it as a leased Device; raises BridgeError if not granted within wait (s)."""
+        deadline=time.monotonic()+wait
+        j=self._call("POST","/api/lease",{"caps":caps,"ttl":ttl,"priority":priority,"client":client,"wait":wait},
+            timeout=wait+self.timeout)
+        while j.get("status")=="queued":
+            left=deadline-time.monotonic()
+            if left<=0:
+                try:self._call("DELETE",f"/api/lease/jobs/{j['job_id']}")
+                except BridgeError:pass
+                raise BridgeError("no device granted before wait expired",body=j)
+            j=self._call("GET",f"/api/lease/jobs/{j['job_id']}",{"wait":left},timeout=left+self.timeout)
+        if j.get("status")!="granted" or not j.get("lease"):raise BridgeError(f"lease {j.get('status')}",body=j)
+        return Device(self,lease=Lease.from_response(j["lease"]))
+
+    def _resolve(self,devices):
+        if devices is None:devices=[d["ip"] for d in self.devices()]
+        return [d if isinstance(d,Device) else Device(self,d) for d in devices]
+
+    def map(self,fn,devices=None,concurrency=8,return_exceptions=False):
+        """Run fn(device) for each device (IPs or Devices; default every reachable one), at most concurrency at a time.
+        Results come back in input order; with return_exceptions=True failures are returned instead of raised."""
+        ds=self._resolve(devices)
+        def one(d):
+            try:return fn(d)
+            except Exception as e:
+                if return_exceptions:return e
+                raise
+        if not ds:return []
+        with ThreadPoolExecutor(max_workers=max(1,min(concurrency,len(ds)))) as ex:
+            return list(ex.map(one,ds))
+
+# ── asyncio client ───────────────────────────────────────────────────────────
+# Same handles and pool as Bridge; blocking calls run on a worker pool sized to
+# the connection pool, so gather() over different devices runs them in parallel.
+
+class AsyncBridge(_Fleet):
+    def __init__(self,url="http://localhost:5050",timeout=60,pool=32,retries=2):
+        self.sync=Bridge(url,timeout,pool,retries);self.timeout=timeout
+        self._ex=ThreadPoolExecutor(max_workers=pool,thread_name_prefix="udita-client")
+
+    async def close(self):
+        self._ex.shutdown(wait=False);self.sync.close()
+    async def __aenter__(self):return self
+    async def __aexit__(self,*exc):await self.close()
+
+    async def _run(self,fn,*args,**kw):
+        return await asyncio.get_running_loop().run_in_executor(self._ex,lambda:fn(*args,**kw))
+
+    def _call(self,method,path,body=None,headers=None,conv=None,raw=False,timeout=None):
+        return self._run(self.sync._call,method,path,body,headers=headers,conv=conv,raw=raw,timeout=timeout)
+
+    def device(self,ip=None):return Device(self,ip)
+
+    async def devices(self,reachable=True):return await self._run(self.sync.devices,reachable)
+
+    async def lease(self,caps=None,ttl=None,priority=None,client=None,wait=0):
+        d=await self._run(self.sync.lease,caps,ttl,priority,client,wait)
+        return Device(self,lease=d.lease)
+
+    async def map(self,fn,devices=None,concurrency=8,return_exceptions=False):
+        """Await fn(device) for each device (default every reachable one), at most concurrency at a time, in input order."""
+        if devices is None:devices=[d["ip"] for d in await self.devices()]
+        ds=[d if isinstance(d,Device) else Device(self,d) for d in devices]
+        sem=asyncio.Semaphore(max(1,concurrency))
+        async def one(d):
+            async with sem:return await fn(d)
+        return await asyncio.gather(*(one(d) for d in ds),return_exceptions=return_exceptions)
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 """Mac bridge: multi-iPhone remote control via WebDriverAgent (WDA)."""
 
-import argparse,base64,json,logging,os,re,socket,subprocess,threading,time
+import argparse,atexit,base64,bisect,hashlib,io,itertools,json,logging,math,os,re,socket,struct,subprocess,sys,threading,time,uuid,zlib
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor,as_completed
 from datetime import datetime
 from pathlib import Path
 import requests
-from flask import Flask,Response,jsonify,request,send_from_directory
+from flask import Flask,Response,g,has_request_context,jsonify,request,send_from_directory
 from flask_cors import CORS
+from PIL import Image,ImageChops
+from werkzeug.serving import WSGIRequestHandler
 
 logging.basicConfig(level=logging.INFO,format="[%(asctime)s] %(message)s",datefmt="%H:%M:%S")
 log=logging.getLogger("bridge")
@@ -19,75 +22,364 @@ IPHONE_IP=None  # set at startup from env IP or --ip; or pick device in dashboar
 WDA_PORT=int(os.environ.get("WDA_PORT","8100"))
 DW=int(os.environ.get("SCREEN_WIDTH","393"))
 DH=int(os.environ.get("SCREEN_HEIGHT","852"))
-SID=None
+SESSIONS={}  # ip -> WDA session id
+_sess_locks={}  # ip -> lock serializing session creation
 events=[]
 ev_lock=threading.Lock()
 # Multi-device: list of IPs. Load from DEVICES env; add when user selects/sets IP.
 _devices_lock=threading.Lock()
 DEVICES=[]  # manual / env
-# Continuous scan: background thread updates this list.
-SCANNED_DEVICES=[]  # [{"ip":str,"status":"reachable"}, ...]
+# Discovery: passive sources (ARP table, mDNS, registrations) feed this list;
+# the full subnet scan is only a slow fallback.
+SCANNED_DEVICES=[]  # [{"ip":str,"status":"reachable","source":str,"last_seen":float}, ...]
 _scan_lock=threading.Lock()
-SCAN_INTERVAL=15  # seconds
+SCAN_INTERVAL=15  # seconds between liveness checks of known devices
 SCAN_TIMEOUT=0.8  # per-IP timeout
+NEIGHBOR_INTERVAL=float(os.environ.get("NEIGHBOR_INTERVAL","5"))  # ARP/neighbor table poll
+FULL_SCAN_INTERVAL=float(os.environ.get("FULL_SCAN_INTERVAL","300"))  # brute-force /24 fallback
+MDNS=os.environ.get("MDNS","1")!="0"
+# Persistent state (device inventory etc.) lives here across restarts.
+STATE_DIR=Path(os.environ.get("UDITA_STATE_DIR") or Path.home()/".udita")
 
 def ev(t,d=None):
     with ev_lock:
         events.append({"type":t,"ts":datetime.now().isoformat(),**(d or {})})
         if len(events)>2000:events.pop(0)
+    _invalidate_snapshots(_target())  # every logged action may change the UI
+    _meta_invalidate(_target(),"active_app")
+
+def _target():
+    """Device for the current request (lease / X-Device, see _route_device), else the selected one."""
+    if has_request_context():
+        ip=getattr(g,"device",None)
+        if ip:return ip
+    return IPHONE_IP
 
 def wu(ip=None):
-    addr=ip or IPHONE_IP
+    addr=ip or _target()
     return f"http://{addr}:{WDA_PORT}" if addr else None
 
 # ── WDA proxy ─────────────────────────────────────────────────────────────────
 
-def w(method,path,body=None,timeout=15,ip=None):
-    url=wu(ip)
+# Keep-alive connection pool shared by all WDA calls (one small pool per device).
+_http=requests.Session()
+_http.mount("http://",requests.adapters.HTTPAdapter(pool_connections=64,pool_maxsize=16))
+
+def w(method,path,body=None,timeout=None,ip=None,coalesce=False):
+    """Call WDA on a device (default: the request's target). timeout=None picks an adaptive timeout for the route class.
+    coalesce=True lets concurrent identical GETs to the same device share one upstream call."""
+    addr=ip or _target()
+    url=wu(addr)
     if not url:return {"error":"no device selected"}
+    if coalesce and method=="GET" and body is None:return _single_flight(addr,path,timeout)
+    cls=_route_class(path)
+    wait=_breaker_admit(addr)
+    if wait is not None:return {"error":"device unavailable (circuit open)","retry_after":round(wait,1)}
+    t0=time.monotonic()
     try:
-        r=requests.request(method,f"{url}{path}",json=body,timeout=timeout)
-        return r.json()
+        r=_http.request(method,f"{url}{path}",json=body,timeout=timeout or _adaptive_timeout(addr,cls))
+    except (requests.ConnectionError,requests.Timeout) as e:
+        _breaker_record(addr,cls,False);return {"error":str(e)}
+    except Exception as e:
+        _breaker_record(addr,cls,True);return {"error":str(e)}
+    _breaker_record(addr,cls,True,time.monotonic()-t0)
+    try:return r.json()
     except Exception as e:return {"error":str(e)}
 
-def sid():
-    global SID
-    if not IPHONE_IP:return None
-    if SID:
-        r=w("GET",f"/session/{SID}/window/size",timeout=3)
-        if (r.get("value") or {}).get("error")=="invalid session id":
-            log.info("Session expired"); SID=None
-    if not SID:
-        r=w("POST","/session",{"capabilities":{}})
-        SID=r.get("sessionId") or (r.get("value") or {}).get("sessionId")
-        if SID:log.info(f"Session: {SID}")
-    return SID
-
-def wda_ready():
-    if not IPHONE_IP:return False
-    try:return (w("GET","/status",timeout=3).get("value") or {}).get("ready",False)
+# ── Single-flight ────────────────────────────────────────────────────────────
+# WDA handles one request at a time, so N viewers polling the same phone cost
+# N round trips. Opted-in reads join an identical in-flight call instead.
+
+_flights={}  # (ip, path) -> {"done":Event,"result":dict}
+_flight_stats={}  # route -> {"calls":n,"collapsed":n}
+_flight_lock=threading.Lock()
+
+def _single_flight(ip,path,timeout):
+    key=(ip,path)
+    route=request.url_rule.rule if has_request_context() and request.url_rule else "internal"
+    with _flight_lock:
+        f=_flights.get(key);leader=f is None
+        if leader:f=_flights[key]={"done":threading.Event(),"result":None}
+        st=_flight_stats.setdefault(route,{"calls":0,"collapsed":0})
+        st["calls"]+=1
+        if not leader:st["collapsed"]+=1
+    if not leader:f["done"].wait()
+    else:
+        try:f["result"]=w("GET",path,timeout=timeout,ip=ip)
+        finally:
+            with _flight_lock:_flights.pop(key,None)
+            f["done"].set()
+    r=f["result"]
+    return dict(r) if isinstance(r,dict) else r  # each caller may add keys to its own copy
+
+@app.route("/api/singleflight")
+def r_singleflight():
+    """Calls and collapsed (joined an in-flight call) counts per bridge route."""
+    with _flight_lock:
+        routes={k:dict(v) for k,v in _flight_stats.items()};inflight=len(_flights)
+    return jsonify({"in_flight":inflight,"calls":sum(v["calls"] for v in routes.values()),
+        "collapsed":sum(v["collapsed"] for v in routes.values()),"routes":routes})
+
+# ── Per-device circuit breaker and adaptive timeouts ────────────────────────
+# After BREAKER_FAILS consecutive connect/timeout failures a device's breaker
+# opens and calls fail fast; once the cooldown passes a single half-open probe
+# is let through. Timeouts follow each device's observed latency per route
+# class, capped by the class limits below.
+
+BREAKER_FAILS=int(os.environ.get("BREAKER_FAILS","3"))
+BREAKER_COOLDOWN=float(os.environ.get("BREAKER_COOLDOWN","5"))  # first open period (s); doubles per failed probe
+BREAKER_MAX_COOLDOWN=60.0
+LATENCY_SAMPLES=64  # per device and route class
+# Route class -> (floor, cap) timeout in seconds. First matching pattern wins.
+ROUTE_TIMEOUTS={"heavy":(10.0,60.0),"input":(2.0,5.0),"default":(3.0,15.0)}
+ROUTE_CLASSES=[
+    ("heavy",re.compile(r"/(source|wda/accessibleSource|wda/performAccessibilityAudit|wda/video/stop|wda/siri/activate|wda/expectNotification|wda/apps/launchUnattached)$")),
+    ("input",re.compile(r"/(wda/(tap|doubleTap|twoFingerTap|tapWithNumberOfTaps|keys|pressButton)|element/[^/]+/click)$")),
+]
+_health={}  # ip -> breaker state + latency samples
+_health_lock=threading.Lock()
+
+def _route_class(path):
+    p=path.split("?",1)[0]
+    for cls,rx in ROUTE_CLASSES:
+        if rx.search(p):return cls
+    return "default"
+
+def _health_entry(ip):
+    h=_health.get(ip)
+    if h is None:
+        h=_health[ip]={"state":"closed","fails":0,"opened_at":0.0,"cooldown":BREAKER_COOLDOWN,"probing":False,
+            "rejected":0,"lat":{c:deque(maxlen=LATENCY_SAMPLES) for c in ROUTE_TIMEOUTS}}
+    return h
+
+def _breaker_admit(ip):
+    """None if a call to ip may proceed, else seconds until the next probe is allowed."""
+    now=time.monotonic()
+    with _health_lock:
+        h=_health_entry(ip)
+        if h["state"]=="closed":return None
+        if h["state"]=="open" and now>=h["opened_at"]+h["cooldown"]:
+            h["state"]="half_open";h["probing"]=True
+            log.info(f"Breaker half-open: {ip}");return None
+        h["rejected"]+=1
+        return max(0.0,h["opened_at"]+h["cooldown"]-now) if h["state"]=="open" else h["cooldown"]
+
+def _breaker_record(ip,cls,ok,latency=None):
+    with _health_lock:
+        h=_health_entry(ip)
+        if ok:
+            if h["state"]!="closed":log.info(f"Breaker closed: {ip}")
+            h.update(state="closed",fails=0,cooldown=BREAKER_COOLDOWN,probing=False)
+            if latency is not None:h["lat"][cls].append(latency)
+            return
+        h["fails"]+=1
+        if h["state"]=="half_open":
+            h.update(state="open",opened_at=time.monotonic(),cooldown=min(BREAKER_MAX_COOLDOWN,h["cooldown"]*2),probing=False)
+        elif h["state"]=="closed" and h["fails"]>=BREAKER_FAILS:
+            h.update(state="open",opened_at=time.monotonic())
+            log.warning(f"Breaker open: {ip} ({h['fails']} failures)")
+
+def _pct(samples,q):
+    v=sorted(samples)
+    return v[min(len(v)-1,int(q*len(v)))] if v else None
+
+def _adaptive_timeout(ip,cls):
+    floor,cap=ROUTE_TIMEOUTS[cls]
+    with _health_lock:
+        lat=list(_health_entry(ip)["lat"][cls])
+    if len(lat)<8:return cap
+    return min(cap,max(floor,_pct(lat,0.95)*4+1.0))
+
+@app.route("/api/breakers")
+def r_breakers():
+    """Breaker state, latency percentiles and current timeouts per device."""
+    now=time.monotonic();out={}
+    with _health_lock:
+        items=[(ip,dict(h,lat={c:list(v) for c,v in h["lat"].items()})) for ip,h in _health.items()]
+    for ip,h in items:
+        out[ip]={"state":h["state"],"consecutive_failures":h["fails"],"rejected":h["rejected"],
+            "retry_after":round(max(0.0,h["opened_at"]+h["cooldown"]-now),1) if h["state"]=="open" else 0,
+            "latency_ms":{c:{"p50":round(_pct(v,0.5)*1000,1),"p95":round(_pct(v,0.95)*1000,1),"n":len(v)} for c,v in h["lat"].items() if v},
+            "timeouts":{c:round(_adaptive_timeout(ip,c),2) for c in ROUTE_TIMEOUTS}}
+    return jsonify({"devices":out})
+
+def sid(ip=None):
+    ip=ip or _target()
+    if not ip:return None
+    s=SESSIONS.get(ip)
+    if s:
+        r=w("GET",f"/session/{s}/window/size",timeout=3,ip=ip,coalesce=True)
+        if (r.get("value") or {}).get("error")!="invalid session id":return s
+        log.info(f"Session expired: {ip}")
+    with _devices_lock:lk=_sess_locks.setdefault(ip,threading.Lock())
+    with lk:
+        cur=SESSIONS.get(ip)
+        if cur and cur!=s:return cur  # another request already replaced it
+        r=w("POST","/session",{"capabilities":{}},ip=ip)
+        s=r.get("sessionId") or (r.get("value") or {}).get("sessionId")
+        if s:log.info(f"Session: {s} ({ip})");SESSIONS[ip]=s;_inv_update(ip,session=s);_sess_created[ip]=_sess_created.get(ip,0)+1
+        else:SESSIONS.pop(ip,None)
+        return s
+
+def wda_ready(ip=None):
+    if not (ip or _target()):return False
+    try:return (w("GET","/status",timeout=3,ip=ip).get("value") or {}).get("ready",False)
     except:return False
 
-def wda_size():
-    s=sid()
-    if not s:return DW,DH
-    v=(w("GET",f"/session/{s}/window/size") or {}).get("value",{})
-    return v.get("width",DW),v.get("height",DH)
+def wda_size(ip=None):
+    ip=ip or _target()
+    known=_inv_get(ip).get("screen") or {}
+    dw,dh=known.get("width",DW),known.get("height",DH)
+    s=sid(ip)
+    if not s:return dw,dh
+    v=(w("GET",f"/session/{s}/window/size",ip=ip) or {}).get("value",{})
+    if v.get("width") and v.get("height"):_inv_update(ip,screen={"width":v["width"],"height":v["height"]})
+    return v.get("width",dw),v.get("height",dh)
+
+# ── Device metadata cache ────────────────────────────────────────────────────
+# Slow-changing device state is cached per device with a TTL per field and
+# refreshed ahead of expiry only while it keeps being read (a field read
+# again during its TTL is refetched just before it expires), so dashboard
+# polls are answered from memory without one-off reads polling the phone.
+# Rotation and UI actions invalidate the fields they can change once WDA has
+# applied them, and a fetch that was already running then is not cached.
+
+META_TTL={"status":2,"size":60,"screen":300,"orientation":10,"battery":30,"device_info":300,"active_app":3}
+_meta={}  # ip -> {field: (monotonic ts, value)}
+_meta_read={}  # (ip, field) -> monotonic ts of last read
+_meta_inflight=set()  # (ip, field) being refreshed
+_meta_gen={}  # (ip, field) -> invalidation count; a fetch that spans an invalidation is not cached
+_meta_stats={"hits":0,"misses":0,"refreshes":0}
+_meta_lock=threading.Lock()
+_meta_pool=ThreadPoolExecutor(max_workers=4)
+
+def _session_get(path,fallback=None):
+    """Fetcher for a session-scoped GET, or `fallback` (sessionless path) when there is no session."""
+    def fetch(ip):
+        s=sid(ip)
+        if s:return w("GET",f"/session/{s}{path}",ip=ip,coalesce=True)
+        return w("GET",fallback,ip=ip,coalesce=True) if fallback else {"error":"no session"}
+    return fetch
+
+def _fetch_size(ip):
+    s=sid(ip)
+    v=(w("GET",f"/session/{s}/window/size",ip=ip,coalesce=True) or {}).get("value") if s else None
+    if not isinstance(v,dict) or not v.get("width") or not v.get("height"):return {"error":"no size"}
+    _inv_update(ip,screen={"width":v["width"],"height":v["height"]})
+    return {"width":v["width"],"height":v["height"]}
+
+def _fetch_status(ip):
+    r=w("GET","/status",timeout=3,ip=ip,coalesce=True)
+    if isinstance(r.get("value"),dict):_inv_update(ip,device_info=r["value"])
+    return r
+
+META_FETCH={"status":_fetch_status,"size":_fetch_size,"screen":_session_get("/wda/screen","/wda/screen"),
+    "orientation":_session_get("/orientation"),"battery":_session_get("/wda/batteryInfo"),
+    "device_info":_session_get("/wda/device/info","/wda/device/info"),"active_app":_session_get("/wda/activeAppInfo","/wda/activeAppInfo")}
+
+def _meta_refresh(ip,field):
+    try:
+        with _meta_lock:gen=_meta_gen.get((ip,field),0)
+        v=META_FETCH[field](ip)
+        with _meta_lock:
+            _meta_stats["refreshes"]+=1
+            if isinstance(v,dict) and not v.get("error") and _meta_gen.get((ip,field),0)==gen:
+                _meta.setdefault(ip,{})[field]=(time.monotonic(),v)
+        return dict(v) if isinstance(v,dict) else v
+    finally:
+        with _meta_lock:_meta_inflight.discard((ip,field))
+
+def _meta_get(field,ip=None):
+    """Cached value of a metadata field for a device; ?fresh=1 on the request bypasses the cache."""
+    ip=ip or _target()
+    if not ip:return {"error":"no device selected"}
+    fresh=has_request_context() and request.args.get("fresh") in ("1","true")
+    now=time.monotonic()
+    with _meta_lock:
+        _meta_read[(ip,field)]=now
+        hit=(_meta.get(ip) or {}).get(field)
+        if hit and not fresh and now-hit[0]<META_TTL[field]:
+            _meta_stats["hits"]+=1;return dict(hit[1])  # callers get a copy, never the cached dict
+        _meta_stats["misses"]+=1;_meta_inflight.add((ip,field))
+    return _meta_refresh(ip,field)
+
+def _meta_invalidate(ip,*fields):
+    if not ip:return
+    with _meta_lock:
+        m=_meta.get(ip) or {}
+        for f in fields or META_TTL:
+            m.pop(f,None);_meta_gen[(ip,f)]=_meta_gen.get((ip,f),0)+1
+
+def _meta_refresher():
+    """Refresh fields that were read again since they were fetched, shortly before they expire."""
+    while True:
+        time.sleep(0.5)
+        now=time.monotonic();due=[]
+        with _meta_lock:
+            for ip,fields in _meta.items():
+                for f,(ts,_) in fields.items():
+                    if _meta_read.get((ip,f),0)>ts and now-ts>=0.8*META_TTL[f] and (ip,f) not in _meta_inflight:
+                        _meta_inflight.add((ip,f));due.append((ip,f))
+        for ip,f in due:_meta_pool.submit(_meta_refresh,ip,f)
+
+def _screen_size(ip=None):
+    """Screen size in points for a device: cache, then inventory, then SCREEN_WIDTH/HEIGHT."""
+    ip=ip or _target()
+    v=_meta_get("size",ip) if ip else {}
+    if not v.get("error") and v.get("width"):return v["width"],v["height"]
+    known=_inv_get(ip).get("screen") or {}
+    return known.get("width",DW),known.get("height",DH)
+
+@app.route("/api/cache")
+def r_cache():
+    """Metadata cache counters and per-device field ages."""
+    now=time.monotonic()
+    with _meta_lock:
+        return jsonify({**_meta_stats,"ttl":META_TTL,
+            "devices":{ip:{f:round(now-ts,2) for f,(ts,_) in m.items()} for ip,m in _meta.items()}})
 
 # ── Generic WDA passthrough ──────────────────────────────────────────────────
-# Any WDA endpoint can be called via /wda/* passthrough
+# Any WDA endpoint can be called via /wda/* passthrough. Status, headers and
+# body chunks are streamed through as they arrive; nothing is decoded.
+
+HOP_HEADERS={"connection","keep-alive","proxy-authenticate","proxy-authorization","te","trailer","trailers",
+    "transfer-encoding","upgrade","host"}
+PASSTHROUGH_CHUNK=64*1024
+_ROUTING_ARGS=("device","lease")
 
 @app.route("/wda/<path:path>",methods=["GET","POST","PUT","DELETE"])
 def wda_passthrough(path):
-    """Pass any request directly to WDA. Session ID auto-injected."""
-    s=sid()
-    body=request.get_json(force=True,silent=True)
-    # If path contains {sessionId}, replace it
+    """Pass any request directly to WDA. {sessionId} in path, query or body is replaced."""
+    ip=_target()
+    if not ip:return jsonify({"error":"no device selected"}),503
     full_path=f"/{path}"
-    if s and "{sessionId}" in full_path:
-        full_path=full_path.replace("{sessionId}",s)
-    r=w(request.method,full_path,body)
-    return jsonify(r)
+    query="&".join(f"{requests.utils.quote(k,safe='{}')}={requests.utils.quote(v,safe='{}')}"
+        for k,vs in request.args.lists() if k not in _ROUTING_ARGS for v in vs)
+    raw=request.get_data()
+    # Only resolve the session (a WDA round trip) when the request asks for it
+    if "{sessionId}" in full_path or "{sessionId}" in query or b"{sessionId}" in raw:
+        s=sid()
+        if not s:return jsonify({"error":"no session"}),503
+        full_path=full_path.replace("{sessionId}",s);query=query.replace("{sessionId}",s)
+        raw=raw.replace(b"{sessionId}",s.encode())
+    headers={k:v for k,v in request.headers.items() if k.lower() not in HOP_HEADERS and k.lower() not in ("content-length","x-lease","x-device")}
+    cls=_route_class(full_path)
+    wait=_breaker_admit(ip)
+    if wait is not None:
+        return jsonify({"error":"device unavailable (circuit open)","retry_after":round(wait,1)}),503,{"Retry-After":str(int(wait)+1),"X-Shed":"1"}
+    t0=time.monotonic()
+    try:
+        r=_http.request(request.method,f"{wu(ip)}{full_path}"+(f"?{query}" if query else ""),data=raw or None,
+            headers=headers,stream=True,timeout=_adaptive_timeout(ip,cls))
+    except (requests.ConnectionError,requests.Timeout) as e:
+        _breaker_record(ip,cls,False);return jsonify({"error":str(e)}),502
+    except Exception as e:
+        _breaker_record(ip,cls,True);return jsonify({"error":str(e)}),502
+    _breaker_record(ip,cls,True,time.monotonic()-t0)
+    def body():
+        try:yield from r.raw.stream(PASSTHROUGH_CHUNK,decode_content=False)
+        finally:r.close()
+    return Response(body(),status=r.status_code,headers=[(k,v) for k,v in r.headers.items() if k.lower() not in HOP_HEADERS],direct_passthrough=True)
 
 # ── Convenience endpoints (wrap WDA with session management) ─────────────────
 
@@ -96,17 +388,13 @@ def r_ping():return jsonify({"status":"ok"})
 
 @app.route("/api/status")
 def r_status():
-    wo=wda_ready()
-    ww,hh=DW,DH
-    if wo:
-        try:ww,hh=wda_size()
-        except:pass
-    info={}
-    if wo:
-        r=w("GET","/status",timeout=3)
-        info=r.get("value",{})
+    ip=_target()
+    info=(_meta_get("status",ip).get("value") or {}) if ip else {}
+    wo=bool(isinstance(info,dict) and info.get("ready"))
+    if not wo:info={}
+    ww,hh=_screen_size(ip) if wo else (DW,DH)
     return jsonify({"wda":"connected" if wo else "not reachable","wda_url":wu() or "",
-        "iphone_ip":IPHONE_IP or "","screen":{"width":ww,"height":hh},"session":SID,
+        "iphone_ip":_target() or "","screen":{"width":ww,"height":hh},"session":SESSIONS.get(_target()),
         "device_info":info})
 
 def _ensure_device(ip):
@@ -124,32 +412,240 @@ def _get_local_subnet():
     except Exception:
         return "192.168.0"
 
-def _check_wda(ip,timeout=SCAN_TIMEOUT):
+def _wda_status(ip,timeout=SCAN_TIMEOUT):
+    """WDA /status value of a host that is ready, else None (no session needed)."""
     try:
-        r=requests.get(f"http://{ip}:{WDA_PORT}/status",timeout=timeout)
-        return (r.json().get("value") or {}).get("ready",False)
+        v=requests.get(f"http://{ip}:{WDA_PORT}/status",timeout=timeout).json().get("value")
+        return v if isinstance(v,dict) and v.get("ready") else None
     except Exception:
-        return False
+        return None
+
+def _check_wda(ip,timeout=SCAN_TIMEOUT):
+    return _wda_status(ip,timeout) is not None
+
+def _remember(ip,info):
+    """Keep what discovery learned (status, screen size) in the inventory so lease capabilities can match."""
+    _inv_update(ip,device_info=info)
+    if _inv_get(ip).get("screen"):return
+    try:v=requests.get(f"http://{ip}:{WDA_PORT}/window/size",timeout=2).json().get("value")
+    except Exception:return
+    if isinstance(v,dict) and v.get("width") and v.get("height"):_inv_update(ip,screen={"width":v["width"],"height":v["height"]})
+
+NEGATIVE_TTL=600  # seconds before a host without WDA is probed again
+_probed={}  # ip -> monotonic ts of last failed probe
+_probe_pool=ThreadPoolExecutor(max_workers=8)
+
+def _mark_found(ip,source,info=None):
+    now=time.time()
+    with _scan_lock:
+        for d in SCANNED_DEVICES:
+            if d["ip"]==ip:d.update(status="reachable",last_seen=now);break
+        else:
+            SCANNED_DEVICES.append({"ip":ip,"status":"reachable","source":source,"last_seen":now})
+            log.info(f"Discovered {ip} via {source}")
+        _probed.pop(ip,None)
+    _inv_update(ip,last_seen=now)
+    if info:_remember(ip,info)
+
+def _known_ips():
+    with _scan_lock:return {d["ip"] for d in SCANNED_DEVICES if d["status"]=="reachable"}
+
+def _probe(ip,source,force=False):
+    """Check one candidate host; negative results are cached for NEGATIVE_TTL."""
+    if not force:
+        with _scan_lock:
+            last=_probed.get(ip)
+            if last and time.monotonic()-last<NEGATIVE_TTL:return False
+            _probed[ip]=time.monotonic()  # also stops duplicate concurrent probes
+    info=_wda_status(ip)
+    if info:_mark_found(ip,source,info);return True
+    with _scan_lock:_probed[ip]=time.monotonic()
+    return False
+
+def _candidate(ip,source):
+    """Queue a probe for a newly seen host unless it is known or recently rejected."""
+    if not ip or ip in _known_ips() or ip.startswith(("127.","224.","239.","255.","169.254.")) or ip.endswith(".255"):return
+    with _scan_lock:
+        last=_probed.get(ip)
+        if last and time.monotonic()-last<NEGATIVE_TTL:return
+    _probe_pool.submit(_probe,ip,source)
 
 def _scan_subnet():
+    """Brute-force probe of the local /24 (fallback when passive sources miss a device)."""
     subnet=_get_local_subnet()
     ips=[f"{subnet}.{i}" for i in range(1,255)]
-    found=[]
     with ThreadPoolExecutor(max_workers=50) as ex:
-        def check(ip):
-            return (ip,_check_wda(ip))
-        for ip,ok in ex.map(check,ips):
-            if ok:found.append(ip)
-    with _scan_lock:
-        global SCANNED_DEVICES
-        SCANNED_DEVICES=[{"ip":ip,"status":"reachable"} for ip in found]
+        found=[(ip,info) for ip,info in zip(ips,ex.map(_wda_status,ips)) if info]
+    for ip,info in found:_mark_found(ip,"scan",info)
     if found:log.info(f"Scan found: {found}")
 
+def _neighbor_ips():
+    """IPv4 hosts in the OS ARP/neighbor table (Linux /proc, `ip neigh` or `arp -an`)."""
+    try:
+        with open("/proc/net/arp") as f:
+            return [l.split()[0] for l in f.read().splitlines()[1:] if len(l.split())>3 and l.split()[2]!="0x0"]
+    except OSError:pass
+    for cmd in (["arp","-an"],["ip","-4","neigh"]):
+        try:out=subprocess.run(cmd,capture_output=True,text=True,timeout=3).stdout
+        except Exception:continue
+        return [m for m in re.findall(r"\(?(\d+\.\d+\.\d+\.\d+)\)?[^\n]*?(?:at|lladdr) [0-9a-f]{1,2}:",out)]
+    return []
+
+def _check_known():
+    """Re-probe known devices in parallel and drop those that stopped answering."""
+    with _scan_lock:ips=[d["ip"] for d in SCANNED_DEVICES]
+    if not ips:return
+    with ThreadPoolExecutor(max_workers=min(16,len(ips))) as ex:
+        alive=dict(zip(ips,ex.map(lambda ip:_wda_status(ip,timeout=2),ips)))
+    lost=[ip for ip,ok in alive.items() if not ok]
+    for ip,info in alive.items():
+        if info:_remember(ip,info)
+    with _scan_lock:
+        SCANNED_DEVICES[:]=[d for d in SCANNED_DEVICES if alive.get(d["ip"],True)]
+        for d in SCANNED_DEVICES:
+            if alive.get(d["ip"]):d.update(status="reachable",last_seen=time.time())
+    if lost:log.info(f"Lost: {lost}")
+
+# mDNS: any packet to 224.0.0.251:5353 reveals its sender's address. iPhones
+# announce themselves when joining Wi-Fi and answer the occasional PTR query
+# below, so new phones are probed once within a second instead of by sweep.
+MDNS_GROUP=("224.0.0.251",5353)
+MDNS_QUERY_INTERVAL=60
+MDNS_SERVICES=("_apple-mobdev2._tcp.local","_rdlink._tcp.local")
+
+def _mdns_query(names):
+    q=b"\x00\x00\x00\x00"+len(names).to_bytes(2,"big")+b"\x00\x00\x00\x00\x00\x00"
+    for n in names:
+        q+=b"".join(len(p).to_bytes(1,"big")+p.encode() for p in n.split("."))+b"\x00\x00\x0c\x00\x01"
+    return q
+
+def _mdns_listener():
+    try:
+        sk=socket.socket(socket.AF_INET,socket.SOCK_DGRAM,socket.IPPROTO_UDP)
+        sk.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        if hasattr(socket,"SO_REUSEPORT"):sk.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEPORT,1)
+        sk.bind(("",MDNS_GROUP[1]))
+        sk.setsockopt(socket.IPPROTO_IP,socket.IP_ADD_MEMBERSHIP,socket.inet_aton(MDNS_GROUP[0])+socket.inet_aton("0.0.0.0"))
+        sk.settimeout(1.0)
+    except OSError as e:
+        log.warning(f"mDNS listener disabled: {e}");return
+    log.info("mDNS listener running")
+    query=_mdns_query(MDNS_SERVICES);next_q=0.0
+    while True:
+        if time.monotonic()>=next_q:
+            try:sk.sendto(query,MDNS_GROUP)
+            except OSError:pass
+            next_q=time.monotonic()+MDNS_QUERY_INTERVAL
+        try:_,(src,_)=sk.recvfrom(9000)
+        except socket.timeout:continue
+        except OSError:time.sleep(1);continue
+        _candidate(src,"mdns")
+
+FULL_SCAN_GRACE=10  # seconds after startup before sweeping, skipped if devices were found
+
 def _scanner_loop():
+    last_check=0.0;next_full=time.monotonic()+FULL_SCAN_GRACE;first_full=True
     while True:
-        try:_scan_subnet()
+        try:
+            for ip in _neighbor_ips():_candidate(ip,"arp")
+            now=time.monotonic()
+            if now-last_check>=SCAN_INTERVAL:
+                _check_known();last_check=now
+            if now>=next_full:
+                if not (first_full and _known_ips()):_scan_subnet()
+                first_full=False;next_full=time.monotonic()+FULL_SCAN_INTERVAL
         except Exception as e:log.warning(f"Scan error: {e}")
-        time.sleep(SCAN_INTERVAL)
+        time.sleep(NEIGHBOR_INTERVAL)
+
+# ── Device inventory (warm start) ────────────────────────────────────────────
+# Last-known facts per device are persisted so a restarted bridge can list
+# devices and reuse sessions immediately, then revalidate in the background.
+
+INVENTORY_FILE=STATE_DIR/"inventory.json"
+INVENTORY_FLUSH=2  # seconds between writes of a dirty inventory
+_inventory={}  # ip -> {"ip","screen","device_info","session","last_seen"}
+_inv_lock=threading.Lock()
+_inv_dirty=False
+_inv_report={}  # worker: ip -> fields changed since the router last pulled them
+
+def _inv_get(ip):
+    with _inv_lock:return dict(_inventory.get(ip) or {})
+
+def _inv_update(ip,**fields):
+    global _inv_dirty
+    if not ip:return
+    with _inv_lock:
+        e=_inventory.setdefault(ip,{"ip":ip})
+        if any(e.get(k)!=v for k,v in fields.items()):
+            e.update(fields);_inv_dirty=True
+            if SHARD is not None:_inv_report.setdefault(ip,{}).update(fields)
+
+def _inv_load():
+    try:data=json.loads(INVENTORY_FILE.read_text())
+    except FileNotFoundError:return
+    except Exception as e:log.warning(f"Inventory unreadable ({INVENTORY_FILE}): {e}");return
+    with _inv_lock:
+        _inventory.update({ip:dict(e,ip=ip) for ip,e in (data.get("devices") or {}).items() if isinstance(e,dict)})
+    log.info(f"Inventory: {len(_inventory)} device(s) from {INVENTORY_FILE}")
+
+def _inv_save():
+    global _inv_dirty
+    with _inv_lock:
+        if not _inv_dirty:return
+        data=json.dumps({"devices":_inventory},indent=1,sort_keys=True);_inv_dirty=False
+    try:
+        STATE_DIR.mkdir(parents=True,exist_ok=True)
+        tmp=INVENTORY_FILE.with_suffix(".tmp");tmp.write_text(data);os.replace(tmp,INVENTORY_FILE)
+    except Exception as e:log.warning(f"Inventory save failed: {e}")
+
+def _inv_flusher():
+    while True:
+        time.sleep(INVENTORY_FLUSH)
+        _inv_save()
+
+def _revalidate(ip):
+    """Check reachability and the stored session of one inventory device (sharded: reachability only)."""
+    info=(w("GET","/status",timeout=2,ip=ip) or {}).get("value") or {}
+    if not isinstance(info,dict) or not info.get("ready"):return ip,False
+    e=_inv_get(ip);_inv_update(ip,last_seen=time.time(),device_info=info)
+    if e.get("session") and not _shards:  # workers own sessions and report them back
+        v=(w("GET",f"/session/{e['session']}/window/size",timeout=3,ip=ip) or {}).get("value") or {}
+        if v.get("error") or not v.get("width"):_inv_update(ip,session=None)
+        else:_inv_update(ip,screen={"width":v["width"],"height":v["height"]})
+    return ip,True
+
+def _warm_start():
+    """Serve the persisted inventory now; revalidate every known device in parallel."""
+    global SCANNED_DEVICES
+    with _inv_lock:known=sorted(_inventory.values(),key=lambda e:-(e.get("last_seen") or 0))
+    with _scan_lock:
+        if not SCANNED_DEVICES:
+            SCANNED_DEVICES=[{"ip":e["ip"],"status":"cached","last_seen":e.get("last_seen")} for e in known]
+    for e in known:
+        if e.get("session") and not _shards:SESSIONS.setdefault(e["ip"],e["session"])
+    def _run():
+        global IPHONE_IP,DW,DH
+        with _devices_lock:ips=set(DEVICES)
+        ips|={e["ip"] for e in known}
+        if IPHONE_IP:ips.add(IPHONE_IP)
+        if not ips:return
+        with ThreadPoolExecutor(max_workers=min(16,len(ips))) as ex:
+            for ip,ok in ex.map(_revalidate,ips):
+                with _scan_lock:
+                    for d in SCANNED_DEVICES:
+                        if d["ip"]==ip and d["status"]=="cached":d["status"]="reachable" if ok else "not reachable"
+        if wda_ready():
+            log.info("WDA: CONNECTED")
+            try:
+                r=w("GET","/status",timeout=3)
+                ip=(r.get("value") or {}).get("ios",{}).get("ip")
+                if ip:IPHONE_IP=ip
+            except Exception:pass
+            if not _shards:DW,DH=wda_size();log.info(f"Screen: {DW}x{DH}");sid()
+        elif IPHONE_IP:
+            log.warning("WDA not reachable")
+        _inv_save()
+    threading.Thread(target=_run,daemon=True).start()
 
 @app.route("/api/scan-now",methods=["POST"])
 def r_scan_now():
@@ -160,6 +656,21 @@ def r_scan_now():
     threading.Thread(target=_run,daemon=True).start()
     return jsonify({"status":"ok","message":"Scan started; refresh devices in a few seconds"})
 
+@app.route("/api/devices/register",methods=["POST"])
+def r_register():
+    """Devices or relays announce WDA hosts: {"ip":...} or {"devices":[{"ip":...},...]}; ip defaults to the caller."""
+    d=request.get_json(force=True,silent=True) or {}
+    if not isinstance(d,dict):return jsonify({"error":"Expected a JSON object"}),400
+    items=d.get("devices") if isinstance(d.get("devices"),list) else [d]
+    ips=[(x.get("ip") if isinstance(x,dict) else x) or "" for x in items]
+    if not all(isinstance(ip,str) for ip in ips):return jsonify({"error":"ip must be a string"}),400
+    ips=[ip.strip() for ip in ips if ip.strip()] or ([request.remote_addr] if request.remote_addr else [])
+    if not ips:return jsonify({"error":"Missing ip"}),400
+    with ThreadPoolExecutor(max_workers=min(16,len(ips))) as ex:
+        ok=list(ex.map(lambda ip:_probe(ip,"registered",force=True),ips))
+    ev("register",{"devices":ips})
+    return jsonify({"status":"ok","devices":[{"ip":ip,"status":"reachable" if o else "not reachable"} for ip,o in zip(ips,ok)]})
+
 @app.route("/api/devices")
 def r_devices():
     """List devices: scanned (continuous) + manual IPs. Click one to select."""
@@ -173,28 +684,801 @@ def r_devices():
         out.append({"ip":ip,"status":"reachable" if _check_wda(ip,timeout=2) else "not reachable"})
     if not out and IPHONE_IP:
         out=[{"ip":IPHONE_IP,"status":"reachable" if _check_wda(IPHONE_IP,timeout=2) else "not reachable"}]
+    with _lease_cond:held={l["ip"]:l.get("client") or l["id"] for l in _leases.values()}
+    out=[dict(d,leased_by=held[d["ip"]]) if d["ip"] in held else d for d in out]
     return jsonify({"devices":out,"current":IPHONE_IP})
 
 @app.route("/api/device/select",methods=["POST"])
 def r_device_select():
-    global IPHONE_IP,SID
+    global IPHONE_IP
     d=request.get_json(force=True,silent=True) or {}
     ip=(d.get("ip") or "").strip()
     if not ip:return jsonify({"error":"Missing ip"}),400
-    IPHONE_IP=ip;SID=None
+    IPHONE_IP=ip
+    if _inv_get(ip).get("session"):SESSIONS.setdefault(ip,_inv_get(ip)["session"])  # sid() revalidates
     _ensure_device(ip)
     log.info(f"Selected device: {ip}")
     return jsonify({"status":"ok","ip":IPHONE_IP})
 
 @app.route("/api/set-ip",methods=["POST"])
 def r_setip():
-    global IPHONE_IP,SID
+    global IPHONE_IP
     d=request.get_json(force=True,silent=True) or {}
     raw=d.get("ip",IPHONE_IP or "")
-    IPHONE_IP=(raw.strip() if raw else None);SID=None
+    IPHONE_IP=(raw.strip() if raw else None)
+    if _inv_get(IPHONE_IP).get("session"):SESSIONS.setdefault(IPHONE_IP,_inv_get(IPHONE_IP)["session"])
     if IPHONE_IP:_ensure_device(IPHONE_IP)
     return jsonify({"status":"ok","ip":IPHONE_IP})
 
+# ── Device leases and job queue ──────────────────────────────────────────────
+# CI jobs acquire a device by capability and address it with the X-Lease
+# header (or ?lease=), so selecting a device in the dashboard no longer moves
+# anyone's tests. Leases expire unless heartbeated (any request carrying the
+# lease counts); acquisitions that cannot be served wait in a priority/FIFO
+# queue and are granted as devices free up. State survives restarts.
+
+LEASE_FILE=STATE_DIR/"leases.json"
+LEASE_TTL=float(os.environ.get("LEASE_TTL","60"))  # default lease / queue ticket TTL (s)
+LEASE_MAX_WAIT=300  # longest a single acquire or poll call may block (s)
+LEASE_CAPS=("ip","ios","min_ios","max_ios","device","width","height")
+_leases={}  # lease id -> {"id","ip","client","caps","ttl","granted","expires","job"}
+_lease_jobs={}  # job id -> {"id","caps","priority","client","ttl","seq","enqueued","expires","state","lease"}
+_lease_cond=threading.Condition()
+_lease_seq=itertools.count()
+_lease_dirty=False
+_util={"since":time.time(),"leased_s":0.0,"available_s":0.0}
+# Fleet-level routes; everything else under /api and /wda acts on one device.
+FLEET_ROUTES=("/api/ping","/api/devices","/api/device/select","/api/set-ip","/api/scan-now","/api/lease","/api/breakers","/api/events","/api/singleflight","/api/jobs","/api/templates","/api/admission","/api/telemetry","/api/shard")
+
+@app.before_request
+def _route_device():
+    """Resolve the request's device from X-Lease / X-Device (or ?lease= / ?device=); keep others off leased devices."""
+    if not request.path.startswith(("/api/","/wda/")) or request.path.startswith(FLEET_ROUTES):return None
+    lid=request.headers.get("X-Lease") or request.args.get("lease")
+    if lid:
+        with _lease_cond:
+            l=_leases.get(lid)
+            if l:l["expires"]=max(l["expires"],time.time()+l["ttl"])
+        if not l:return jsonify({"error":"unknown or expired lease"}),410
+        g.device=l["ip"];return None
+    g.device=(request.headers.get("X-Device") or request.args.get("device") or "").strip() or None
+    if request.method!="GET":
+        ip=_target()
+        with _lease_cond:held=next((l for l in _leases.values() if l["ip"]==ip),None)
+        if held:return jsonify({"error":f"device {ip} is leased","client":held.get("client"),"expires":held["expires"]}),423
+    return None
+
+def _lease_pool():
+    """Devices that may be leased: discovered + manual, minus those with an open breaker."""
+    with _devices_lock:ips=set(DEVICES)
+    ips|=_known_ips()
+    with _health_lock:down={ip for ip,h in _health.items() if h["state"]=="open"}
+    return sorted(ips-down)
+
+def _ver(v):
+    return tuple(int(x) for x in re.findall(r"\d+",str(v))[:3])
+
+def _caps_match(ip,caps):
+    e=_inv_get(ip);info=e.get("device_info") or {};scr=e.get("screen") or {}
+    osv=_ver((info.get("os") or {}).get("version",""))
+    for k,v in (caps or {}).items():
+        if k=="ip" and ip!=v:return False
+        if k=="ios" and (not osv or osv[:len(_ver(v))]!=_ver(v)):return False
+        if k=="min_ios" and (not osv or osv<_ver(v)):return False
+        if k=="max_ios" and (not osv or osv[:len(_ver(v))]>_ver(v)):return False
+        if k=="device" and str(info.get("device","")).lower()!=str(v).lower():return False
+        if k in ("width","height") and scr.get(k)!=v:return False
+    return True
+
+def _lease_schedule():
+    """Grant queued jobs by priority, then FIFO; later jobs may backfill devices earlier ones cannot use. Hold _lease_cond."""
+    global _lease_dirty
+    busy={l["ip"] for l in _leases.values()}
+    free=[ip for ip in _lease_pool() if ip not in busy]
+    granted=False
+    for j in sorted((j for j in _lease_jobs.values() if j["state"]=="queued"),key=lambda j:(-j["priority"],j["seq"])):
+        if not free:break
+        ip=next((ip for ip in free if _caps_match(ip,j["caps"])),None)
+        if not ip:continue
+        free.remove(ip);now=time.time()
+        l={"id":uuid.uuid4().hex,"ip":ip,"client":j["client"],"caps":j["caps"],"ttl":j["ttl"],"granted":now,"expires":now+j["ttl"],"job":j["id"]}
+        _leases[l["id"]]=l;j.update(state="granted",lease=l["id"],expires=now+j["ttl"])
+        log.info(f"Lease {l['id'][:8]}: {ip} -> {j['client'] or j['id'][:8]}");granted=True
+    if granted:_lease_dirty=True;_lease_cond.notify_all()
+
+def _lease_view(l):
+    return {k:l[k] for k in ("id","ip","client","caps","ttl","granted","expires")}
+
+def _job_view(j):
+    out={"job_id":j["id"],"status":j["state"],"priority":j["priority"],"client":j["client"],"caps":j["caps"]}
+    if j["state"]=="queued":
+        q=sorted((x for x in _lease_jobs.values() if x["state"]=="queued"),key=lambda x:(-x["priority"],x["seq"]))
+        out["position"]=q.index(j)+1;out["queue_depth"]=len(q)
+    elif j["state"]=="granted" and j["lease"] in _leases:out["lease"]=_lease_view(_leases[j["lease"]])
+    return out
+
+def _lease_wait(j,wait):
+    """Block up to `wait` seconds for a queued job to be granted. Hold _lease_cond."""
+    deadline=time.monotonic()+min(max(0.0,wait),LEASE_MAX_WAIT)
+    while j["state"]=="queued":
+        rem=deadline-time.monotonic()
+        if rem<=0:break
+        _lease_cond.wait(rem)
+
+def _lease_stats():
+    pool=_lease_pool();leased=sum(1 for l in _leases.values() if l["ip"] in pool)
+    return {"devices":len(pool),"leased":leased,"free":len(pool)-leased,
+        "queue_depth":sum(1 for j in _lease_jobs.values() if j["state"]=="queued"),
+        "utilization":round(leased/len(pool),3) if pool else 0.0,
+        "utilization_avg":round(_util["leased_s"]/_util["available_s"],3) if _util["available_s"] else 0.0,
+        "since":_util["since"]}
+
+def _lease_save():
+    global _lease_dirty
+    with _lease_cond:
+        if not _lease_dirty:return
+        data=json.dumps({"leases":_leases,"jobs":_lease_jobs},indent=1);_lease_dirty=False
+    try:
+        STATE_DIR.mkdir(parents=True,exist_ok=True)
+        tmp=LEASE_FILE.with_suffix(".tmp");tmp.write_text(data);os.replace(tmp,LEASE_FILE)
+    except Exception as e:log.warning(f"Lease save failed: {e}")
+
+def _lease_load():
+    """Restore leases and queued jobs; clients get one TTL of grace to resume heartbeats."""
+    try:data=json.loads(LEASE_FILE.read_text())
+    except FileNotFoundError:return
+    except Exception as e:log.warning(f"Leases unreadable ({LEASE_FILE}): {e}");return
+    now=time.time()
+    with _lease_cond:
+        for l in (data.get("leases") or {}).values():
+            _leases[l["id"]]=dict(l,expires=max(l["expires"],now+l["ttl"]))
+        for j in sorted((data.get("jobs") or {}).values(),key=lambda j:j["seq"]):
+            if j["state"]=="granted" and j.get("lease") not in _leases:continue
+            _lease_jobs[j["id"]]=dict(j,seq=next(_lease_seq),expires=max(j["expires"],now+j["ttl"]))
+    log.info(f"Leases: {len(_leases)} active, {sum(1 for j in _lease_jobs.values() if j['state']=='queued')} queued")
+
+def _lease_reaper():
+    """Reclaim expired leases and abandoned queue tickets, grant waiting jobs, track utilization."""
+    global _lease_dirty
+    last=time.monotonic();last_save=0.0
+    while True:
+        time.sleep(1)
+        now=time.time();mono=time.monotonic()
+        with _lease_cond:
+            for lid,l in list(_leases.items()):
+                if l["expires"]<=now:
+                    del _leases[lid];_lease_jobs.pop(l.get("job"),None);_lease_dirty=True
+                    log.info(f"Lease {lid[:8]} expired: {l['ip']} reclaimed");ev("lease_reclaimed",{"ip":l["ip"],"client":l.get("client")})
+            for jid,j in list(_lease_jobs.items()):
+                if j["expires"]<=now and j["lease"] not in _leases:del _lease_jobs[jid];_lease_dirty=True
+            _lease_schedule()
+            pool=_lease_pool()
+            _util["available_s"]+=(mono-last)*len(pool)
+            _util["leased_s"]+=(mono-last)*sum(1 for l in _leases.values() if l["ip"] in pool)
+        last=mono
+        if mono-last_save>=2:_lease_save();last_save=mono
+
+@app.route("/api/lease",methods=["POST"])
+def r_lease_acquire():
+    """Acquire a device: {"caps":{...},"ttl":s,"priority":int,"client":str,"wait":s}. 200 with a lease, or 202 queued."""
+    global _lease_dirty
+    d=request.get_json(force=True,silent=True) or {}
+    caps=d.get("caps") or {}
+    if not isinstance(caps,dict) or set(caps)-set(LEASE_CAPS):return jsonify({"error":f"caps may only use {', '.join(LEASE_CAPS)}"}),400
+    try:
+        ttl=max(5.0,float(d.get("ttl",LEASE_TTL)));prio=int(d.get("priority",0));wait=float(d.get("wait",0))
+    except (TypeError,ValueError):return jsonify({"error":"Invalid ttl/priority/wait"}),400
+    now=time.time()
+    j={"id":uuid.uuid4().hex,"caps":caps,"priority":prio,"client":str(d.get("client") or request.remote_addr or ""),
+        "ttl":ttl,"seq":next(_lease_seq),"enqueued":now,"expires":now+ttl,"state":"queued","lease":None}
+    with _lease_cond:
+        _lease_jobs[j["id"]]=j;_lease_dirty=True
+        _lease_schedule();_lease_wait(j,wait)
+        out=_job_view(j)
+    if out["status"]=="granted":ev("lease",{"ip":out["lease"]["ip"],"client":j["client"]})
+    return jsonify(out),200 if out["status"]=="granted" else 202
+
+@app.route("/api/lease/jobs/<jid>",methods=["GET"])
+def r_lease_job(jid):
+    """Poll a queued acquisition (?wait=s to long-poll). Polling keeps the ticket alive."""
+    try:wait=float(request.args.get("wait",0))
+    except ValueError:return jsonify({"error":"Invalid wait"}),400
+    with _lease_cond:
+        j=_lease_jobs.get(jid)
+        if not j:return jsonify({"error":"unknown or expired job"}),404
+        if j["state"]=="queued":j["expires"]=time.time()+j["ttl"]
+        _lease_wait(j,wait)
+        return jsonify(_job_view(j)),200 if j["state"]=="granted" else 202
+
+@app.route("/api/lease/jobs/<jid>",methods=["DELETE"])
+def r_lease_job_cancel(jid):
+    global _lease_dirty
+    with _lease_cond:
+        j=_lease_jobs.pop(jid,None)
+        if not j:return jsonify({"error":"unknown or expired job"}),404
+        _lease_dirty=True
+        if j["state"]=="granted" and _leases.pop(j["lease"],None):_lease_schedule()
+    return jsonify({"status":"ok"})
+
+@app.route("/api/lease/<lid>",methods=["GET"])
+def r_lease_get(lid):
+    with _lease_cond:
+        l=_leases.get(lid)
+        return jsonify(_lease_view(l)) if l else (jsonify({"error":"unknown or expired lease"}),404)
+
+@app.route("/api/lease/<lid>/heartbeat",methods=["POST"])
+def r_lease_heartbeat(lid):
+    global _lease_dirty
+    with _lease_cond:
+        l=_leases.get(lid)
+        if not l:return jsonify({"error":"unknown or expired lease"}),404
+        l["expires"]=time.time()+l["ttl"];_lease_dirty=True
+        return jsonify(_lease_view(l))
+
+@app.route("/api/lease/<lid>",methods=["DELETE"])
+@app.route("/api/lease/<lid>/release",methods=["POST"])
+def r_lease_release(lid):
+    global _lease_dirty
+    with _lease_cond:
+        l=_leases.pop(lid,None)
+        if not l:return jsonify({"error":"unknown or expired lease"}),404
+        _lease_jobs.pop(l.get("job"),None);_lease_dirty=True
+        _lease_schedule()
+    ev("lease_release",{"ip":l["ip"],"client":l.get("client")})
+    return jsonify({"status":"ok","ip":l["ip"]})
+
+@app.route("/api/lease/stats")
+def r_lease_stats():
+    with _lease_cond:return jsonify(_lease_stats())
+
+@app.route("/api/leases")
+def r_leases():
+    with _lease_cond:
+        q=sorted((j for j in _lease_jobs.values() if j["state"]=="queued"),key=lambda j:(-j["priority"],j["seq"]))
+        return jsonify({"leases":[_lease_view(l) for l in _leases.values()],"queue":[_job_view(j) for j in q],"stats":_lease_stats()})
+
+# ── Sharded workers ──────────────────────────────────────────────────────────
+# With --workers N (or env WORKERS; "auto" = one per CPU) this process becomes
+# a front router: discovery, inventory, leases, telemetry files and the
+# dashboard stay here, while every device request is streamed to one of N
+# worker processes on 127.0.0.1 that owns the device's session, connection
+# pool, caches, breaker, admission queue and jobs. Devices are placed on a
+# consistent-hash ring (SHARD_VNODES points per worker) with bounded load: no
+# worker takes more than SHARD_LOAD x the mean, and current placements stick,
+# so adding a device or losing / regaining a worker only moves the devices
+# that have to move. Dead or hung workers are restarted with backoff; their
+# devices fail over to the survivors meanwhile (the new owner opens its own
+# WDA session). The router itself never opens a session: it only checks that
+# devices are reachable, and the supervisor pulls the sessions, screen sizes
+# and device info workers learn so inventory.json stays current.
+
+SHARD=None  # worker index when this process is a shard worker
+SHARD_VNODES=64  # ring points per worker
+SHARD_LOAD=1.25  # most devices one worker may own, relative to the mean
+SHARD_CHECK=2.0  # seconds between worker health checks
+SHARD_START=30  # seconds a new worker has to answer /api/ping
+SHARD_MERGE=("/api/events","/api/jobs","/api/breakers","/api/admission","/api/singleflight")
+_shards=[]  # router: [{"i","port","proc","alive","fails","restarts","started","next_start","vnodes"}]
+_assign={}  # router: ip -> worker index
+_shard_lock=threading.Lock()
+_shard_http=requests.Session()
+_shard_http.mount("http://",requests.adapters.HTTPAdapter(pool_connections=16,pool_maxsize=64))
+_shard_pool=ThreadPoolExecutor(max_workers=8,thread_name_prefix="shard")  # per-worker calls only: never submit a task that waits on it
+
+def _hash(s):
+    return int.from_bytes(hashlib.md5(s.encode()).digest()[:8],"big")
+
+def _shard_rebalance(extra=()):
+    """Place every known device on a live worker: ring order, bounded load, current placements kept."""
+    with _devices_lock:ips=set(DEVICES)
+    ips|=_known_ips()|set(extra)
+    if IPHONE_IP:ips.add(IPHONE_IP)
+    with _shard_lock:
+        ips=sorted(ips|set(_assign),key=_hash)
+        live=[s for s in _shards if s["alive"]]
+        if not live:return  # keep placements until a worker is back
+        new,load={},{s["i"]:0 for s in live}
+        cap=math.ceil(SHARD_LOAD*len(ips)/len(live))
+        for ip in ips:
+            i=_assign.get(ip)
+            if i in load and load[i]<cap:new[ip]=i;load[i]+=1
+        ring=sorted(v for s in live for v in s["vnodes"])
+        for ip in ips:
+            if ip in new:continue
+            k=bisect.bisect_left(ring,(_hash(ip),-1))
+            for j in range(len(ring)):
+                i=ring[(k+j)%len(ring)][1]
+                if load[i]<cap:new[ip]=i;load[i]+=1;break
+        moved=[(ip,_assign.get(ip),new[ip]) for ip in ips if _assign.get(ip)!=new[ip]]
+        _assign.clear();_assign.update(new)
+    for ip,old,i in moved:
+        log.info(f"Shard: {ip} {'new' if old is None else f'w{old}'} -> w{i}")
+
+def _shard_owner(ip):
+    """The live worker that owns a device, placing it first if it is new."""
+    with _shard_lock:
+        i=_assign.get(ip)
+        if i is not None and _shards[i]["alive"]:return _shards[i]
+        if not any(s["alive"] for s in _shards):return None
+    _shard_rebalance((ip,))
+    with _shard_lock:i=_assign.get(ip)
+    return _shards[i] if i is not None else None
+
+def _shard_down(s,why):
+    with _shard_lock:
+        was=s["alive"];s["alive"]=False
+    if was:log.warning(f"Shard w{s['i']} down: {why}");_shard_rebalance()
+
+def _shard_call(s,method,path,timeout=(3,600),**kw):
+    return _shard_http.request(method,f"http://127.0.0.1:{s['port']}{path}",timeout=timeout,**kw)
+
+def _shard_proxy(s,ip=None):
+    """Stream the current request to worker s (pinned to device ip); GETs fail over once if the worker is gone."""
+    headers={"Accept-Encoding":None}  # no requests default: the worker compresses only what the client accepts
+    headers.update((k,v) for k,v in request.headers.items() if k.lower() not in HOP_HEADERS and k.lower() not in ("content-length","x-lease","x-device"))
+    if ip:headers["X-Device"]=ip
+    drop=_ROUTING_ARGS+("shard",) if ip else ("shard",)
+    params=[(k,v) for k,v in request.args.items(multi=True) if k not in drop]
+    data=request.get_data()
+    for attempt in (0,1):
+        try:r=_shard_call(s,request.method,request.path,params=params,data=data or None,headers=headers,stream=True)
+        except requests.ConnectionError as e:
+            _shard_down(s,e)
+            if attempt or not ip or request.method not in ("GET","HEAD"):break
+            s=_shard_owner(ip)
+            if not s:break
+            continue
+        except requests.Timeout as e:return jsonify({"error":f"worker w{s['i']} timed out: {e}"}),504
+        def body(r=r,s=s,path=request.path):
+            try:yield from r.raw.stream(PASSTHROUGH_CHUNK,decode_content=False)
+            except Exception as e:log.warning(f"Shard w{s['i']}: {path} cut off: {e}")  # worker died mid-response
+            finally:r.close()
+        return Response(body(),status=r.status_code,headers=[(k,v) for k,v in r.headers.items() if k.lower() not in HOP_HEADERS],direct_passthrough=True)
+    return jsonify({"error":"no worker available for this device"}),503,{"Retry-After":str(int(SHARD_CHECK)+1)}
+
+def _shard_each(method,path,**kw):
+    """JSON answers of all live workers (unreachable ones are skipped)."""
+    with _shard_lock:live=[s for s in _shards if s["alive"]]
+    def one(s):
+        try:return _shard_call(s,method,path,timeout=(1,10),**kw).json()
+        except (requests.RequestException,ValueError):return None
+    return [r for r in _shard_pool.map(one,live) if isinstance(r,dict)]
+
+def _shard_merge(path,out,parts):
+    """Fold the workers' answers to a fleet stats route into the router's own."""
+    for p in parts:
+        if path=="/api/singleflight":
+            for k in ("in_flight","calls","collapsed"):out[k]+=p.get(k,0)
+            for route,st in (p.get("routes") or {}).items():
+                t=out["routes"].setdefault(route,{"calls":0,"collapsed":0})
+                t["calls"]+=st["calls"];t["collapsed"]+=st["collapsed"]
+        elif path in ("/api/breakers","/api/admission"):out["devices"].update(p.get("devices") or {})
+        else:
+            key=path.rsplit("/",1)[1];out[key]+=p.get(key) or [];out["count"]+=p.get("count",0)
+    if path=="/api/events":out["events"]=sorted(out["events"],key=lambda e:e["ts"])[-200:]
+    if path=="/api/jobs":out["jobs"].sort(key=lambda j:j["created"]);out["count"]=len(out["jobs"])
+    return out
+
+@app.before_request
+def _shard_forward():
+    """Router: send device requests to their worker; fan fleet stats out to all workers (?shard=i asks one)."""
+    p=request.path
+    if not _shards or request.method=="OPTIONS" or not p.startswith(("/api/","/wda/")) or p.startswith("/api/shard"):return None
+    if not p.startswith(FLEET_ROUTES):
+        ip=_target()
+        if not ip:return None
+        s=_shard_owner(ip)
+        return _shard_proxy(s,ip) if s else (jsonify({"error":"no worker available"}),503,{"Retry-After":str(int(SHARD_CHECK)+1),"X-Shed":"1"})
+    m=re.match(r"/api/jobs/w(\d+)-",p)
+    sh=m.group(1) if m else request.args.get("shard")
+    if sh is not None:
+        s=_shards[int(sh)] if sh.isdigit() and int(sh)<len(_shards) else None
+        if not s or not s["alive"]:return jsonify({"error":f"worker {sh} is not available"}),503 if s else 404
+        return _shard_proxy(s)
+    if p=="/api/templates" and request.method=="POST":  # cropping the live screen needs the device's worker
+        d=request.get_json(force=True,silent=True) or {}
+        ip=(d.get("device") or "").strip() or IPHONE_IP
+        if isinstance(d.get("rect"),dict) and ip:
+            s=_shard_owner(ip)
+            return _shard_proxy(s,ip) if s else (jsonify({"error":"no worker available"}),503)
+    if p=="/api/events/clear":_shard_each("POST",p)
+    if p in SHARD_MERGE and request.method=="GET":
+        out=app.view_functions[request.endpoint]().get_json()
+        return jsonify(_shard_merge(p,out,_shard_each("GET",p,params=list(request.args.items(multi=True)))))
+    return None
+
+@app.after_request
+def _shard_templates(resp):
+    """Router: after a template is added or deleted, reload it here and on every worker."""
+    if _shards and request.path.startswith("/api/templates") and request.method in ("POST","DELETE") and resp.status_code<300:
+        name=(request.view_args or {}).get("name") or str((request.get_json(force=True,silent=True) or {}).get("name") or "")
+        _tpl_sync(name);threading.Thread(target=_shard_each,args=("POST","/api/shard/templates"),kwargs={"json":{"name":name}},daemon=True).start()
+    return resp
+
+@app.route("/api/shard/templates",methods=["POST"])
+def r_shard_templates():
+    _tpl_sync(str((request.get_json(force=True,silent=True) or {}).get("name") or ""))
+    return jsonify({"status":"ok"})
+
+@app.route("/api/shard/sample")
+def r_shard_sample():
+    """One telemetry sample taken by the device's owner (NaN as null)."""
+    ip=request.args.get("device") or ""
+    if not ip:return jsonify({"error":"Missing device"}),400
+    return jsonify({"sample":[None if isinstance(v,float) and math.isnan(v) else v for v in _tele_sample(ip)]})
+
+@app.route("/api/shard/inventory")
+def r_shard_inventory():
+    """Sessions, screen sizes and device info this worker learned since the last pull; the router persists them."""
+    with _inv_lock:out=dict(_inv_report);_inv_report.clear()
+    return jsonify({"devices":out})
+
+def _shard_inventory(s):
+    """Router: fold one worker's inventory changes into the persisted inventory."""
+    try:devs=_shard_call(s,"GET","/api/shard/inventory",timeout=(1,5)).json()["devices"]
+    except (requests.RequestException,ValueError,KeyError):return
+    for ip,fields in devs.items():_inv_update(ip,**fields)
+
+def _shard_sample(ip):
+    """Router side of the telemetry sampler: ask the owning worker, so no second WDA session is opened."""
+    s=_shard_owner(ip)
+    if not s:return None
+    try:rec=_shard_call(s,"GET","/api/shard/sample",timeout=(1,30),params={"device":ip}).json()["sample"]
+    except (requests.RequestException,ValueError,KeyError):return None
+    return tuple(math.nan if v is None else v for v in rec)
+
+@app.route("/api/shards")
+def r_shards():
+    """Workers, their health and the devices each one owns."""
+    with _shard_lock:
+        owned={}
+        for ip,i in _assign.items():owned.setdefault(i,[]).append(ip)
+        ws=[{"index":s["i"],"port":s["port"],"pid":s["proc"].pid if s["proc"] else None,"alive":s["alive"],"restarts":s["restarts"],
+            "started":s["started"],"devices":sorted(owned.get(s["i"],[]))} for s in _shards]
+    return jsonify({"sharded":bool(_shards),"worker":SHARD,"workers":ws,"vnodes":SHARD_VNODES,"max_load":SHARD_LOAD})
+
+def _shard_spawn(s):
+    s["proc"]=subprocess.Popen([sys.executable,os.path.abspath(__file__),"--worker",str(s["i"]),"--port",str(s["port"])],
+        env=dict(os.environ,UDITA_ROUTER=str(os.getpid())))
+    s["started"]=time.time();s["fails"]=0
+    log.info(f"Shard w{s['i']}: pid {s['proc'].pid} on 127.0.0.1:{s['port']}")
+
+def _shard_check(s):
+    try:ok=_shard_call(s,"GET","/api/ping",timeout=(1,2)).ok
+    except requests.RequestException:ok=False
+    return s,ok
+
+def _shard_supervisor():
+    """Restart dead workers (with backoff), kill hung ones, collect their inventory changes and rebalance."""
+    pool=ThreadPoolExecutor(max_workers=len(_shards),thread_name_prefix="shard-check")  # fan-outs cannot starve the pings
+    while True:
+        now=time.time()
+        for s in _shards:
+            p=s["proc"]
+            if p and p.poll() is not None:
+                s["proc"]=None;s["restarts"]+=1;s["next_start"]=now+min(60,2**min(s["restarts"],6))
+                log.warning(f"Shard w{s['i']} exited ({p.returncode}); restarting in {int(s['next_start']-now)}s")
+                _shard_down(s,"exited")
+            if not s["proc"] and now>=s["next_start"]:_shard_spawn(s)
+        changed=False
+        for s,ok in pool.map(_shard_check,[s for s in _shards if s["proc"]]):
+            with _shard_lock:
+                if ok:changed|=not s["alive"];s["alive"]=True;s["fails"]=0;continue
+                s["fails"]+=1
+                hung=s["fails"]>=3 if s["alive"] else time.time()-s["started"]>SHARD_START
+            if hung:_shard_down(s,"not answering");s["proc"].kill()
+        if changed:log.info(f"Shards live: {sum(s['alive'] for s in _shards)}/{len(_shards)}")
+        list(pool.map(_shard_inventory,[s for s in _shards if s["alive"]]))
+        _shard_rebalance()  # also places newly discovered devices
+        time.sleep(SHARD_CHECK)
+
+def _shard_stop():
+    for s in _shards:
+        if s["proc"]:s["proc"].terminate()
+    for s in _shards:
+        if not s["proc"]:continue
+        try:s["proc"].wait(5)
+        except subprocess.TimeoutExpired:s["proc"].kill()
+
+def _shard_start(n,port):
+    for i in range(n):
+        _shards.append({"i":i,"port":port+1+i,"proc":None,"alive":False,"fails":0,"restarts":0,"started":None,"next_start":0,
+            "vnodes":[(_hash(f"w{i}#{v}"),i) for v in range(SHARD_VNODES)]})
+    for s in _shards:_shard_spawn(s)
+    atexit.register(_shard_stop)
+    threading.Thread(target=_shard_supervisor,daemon=True).start()
+    log.info(f"Sharded: {n} workers on 127.0.0.1:{port+1}-{port+n}")
+
+def _shard_worker(i,port):
+    """Run as worker i: no discovery, leases or persistence, just the devices the router sends."""
+    global SHARD
+    SHARD=i
+    logging.getLogger().handlers[0].setFormatter(logging.Formatter(f"[%(asctime)s] w{i} %(message)s","%H:%M:%S"))
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # the router logs every request already
+    _inv_load();_tpl_load()  # stored sessions and screen sizes; changes go back to the router via /api/shard/inventory
+    threading.Thread(target=_meta_refresher,daemon=True).start()
+    def orphan_watch(ppid=int(os.environ.get("UDITA_ROUTER") or os.getppid())):  # the router may be gone already
+        while os.getppid()==ppid:time.sleep(SHARD_CHECK)
+        os._exit(0)  # router is gone
+    threading.Thread(target=orphan_watch,daemon=True).start()
+    WSGIRequestHandler.protocol_version="HTTP/1.1"  # keep-alive + chunked streams to the router
+    app.run(host="127.0.0.1",port=port,debug=False,threaded=True)
+
+# ── Async jobs ───────────────────────────────────────────────────────────────
+# Any device route can run as a job: send it with "Prefer: respond-async" (or
+# ?async=1) and get 202 + a job id straight away. The request is replayed on a
+# small per-device worker pool, so slow WDA calls (audits, huge sources, video
+# stop, launch) do not hold HTTP threads. Poll or long-poll /api/jobs/<id>,
+# stream its state from /api/jobs/<id>/events, or cancel it. An optional
+# deadline (X-Deadline / ?deadline=, seconds) expires jobs that have not
+# finished in time; WDA calls already in progress cannot be interrupted, so a
+# job cancelled or expired while running just has its result discarded.
+
+JOB_WORKERS=int(os.environ.get("JOB_WORKERS","1"))  # concurrent jobs per device (WDA serializes anyway)
+JOB_QUEUE=int(os.environ.get("JOB_QUEUE","32"))  # queued jobs per device before 429
+JOB_KEEP=600  # seconds finished jobs stay pollable
+JOB_MAX_WAIT=300  # longest a single long-poll may block (s)
+JOB_DONE=("done","failed","cancelled","expired")
+JOB_STRIP_HEADERS=("accept-encoding","prefer","content-length","x-deadline","host")
+_jobs={}  # job id -> {"id","device","method","path","state","created","started","finished","deadline",...}
+_job_pools={}  # ip -> ThreadPoolExecutor
+_job_cond=threading.Condition()
+
+def _async_job_view(j):
+    out={k:j.get(k) for k in ("id","device","method","path","state","created","started","finished","deadline")}
+    if j["state"] in ("done","failed"):
+        out["status_code"]=j.get("status_code");out["error"]=j.get("error")
+        if j.get("mimetype")=="application/json":
+            try:out["result"]=json.loads(j["body"])
+            except (TypeError,ValueError):pass
+    return out
+
+def _job_expire(j,now=None):
+    """Mark a job past its deadline expired; caller holds _job_cond."""
+    if j["state"] not in JOB_DONE and j["deadline"] and (now or time.time())>=j["deadline"]:
+        j["state"]="expired";j["finished"]=time.time();j.pop("body",None);_job_cond.notify_all()
+
+def _job_finish(j,state,**kw):
+    with _job_cond:
+        if j["state"]!="running":return  # cancelled or expired meanwhile
+        if j["deadline"] and time.time()>=j["deadline"]:state,kw="expired",{}
+        j.update(kw,state=state,finished=time.time());_job_cond.notify_all()
+
+def _job_run(j,ctx):
+    with _job_cond:
+        _job_expire(j)
+        if j["state"]!="queued":return
+        j["state"]="running";j["started"]=time.time();_job_cond.notify_all()
+    try:
+        with app.test_request_context(**ctx):
+            resp=app.full_dispatch_request()
+            try:body=resp.get_data()
+            finally:resp.close()  # a streamed body holds its admission slot until closed
+    except Exception as e:
+        log.warning(f"Job {j['id'][:8]} {j['path']} failed: {e}")
+        return _job_finish(j,"failed",error=str(e))
+    _job_finish(j,"done" if resp.status_code<400 else "failed",status_code=resp.status_code,mimetype=resp.mimetype,body=body)
+
+def _job_pool(ip):
+    with _job_cond:
+        p=_job_pools.get(ip)
+        if not p:p=_job_pools[ip]=ThreadPoolExecutor(max_workers=max(1,JOB_WORKERS),thread_name_prefix=f"job-{ip}")
+        return p
+
+@app.before_request
+def _job_submit():
+    """Turn an opted-in device request into a queued job."""
+    if not (request.args.get("async") in ("1","true") or "respond-async" in request.headers.get("Prefer","")):return None
+    if not request.path.startswith("/api/") or request.path.startswith(FLEET_ROUTES):return None
+    e=request.routing_exception  # the URL was matched already: refuse unknown routes now, not on replay
+    if e is not None and e.code>=400:return jsonify({"error":f"{request.method} {request.path}: {e.name.lower()}"}),e.code
+    try:
+        dl=request.headers.get("X-Deadline") or request.args.get("deadline")
+        deadline=time.time()+float(dl) if dl else None
+    except ValueError:return jsonify({"error":"Invalid deadline"}),400
+    ip=_target()
+    if not ip:return jsonify({"error":"no device selected"}),400
+    now=time.time()
+    with _job_cond:
+        for jid,j in list(_jobs.items()):
+            _job_expire(j,now)
+            if j["state"] in JOB_DONE and now-j["finished"]>JOB_KEEP:del _jobs[jid]
+        if sum(1 for j in _jobs.values() if j["device"]==ip and j["state"]=="queued")>=JOB_QUEUE:
+            return jsonify({"error":f"job queue for {ip} is full"}),429
+        j={"id":(f"w{SHARD}-" if SHARD is not None else "")+uuid.uuid4().hex,"device":ip,"method":request.method,"path":request.path,"state":"queued",
+            "created":now,"started":None,"finished":None,"deadline":deadline}
+        _jobs[j["id"]]=j
+    headers=[(k,v) for k,v in request.headers.items() if k.lower() not in JOB_STRIP_HEADERS]
+    if not request.headers.get("X-Lease") and not request.args.get("lease"):
+        headers=[(k,v) for k,v in headers if k.lower()!="x-device"]+[("X-Device",ip)]  # pin to the device resolved now
+    ctx={"path":request.path,"method":request.method,"headers":headers,"data":request.get_data(),
+        "query_string":[(k,v) for k,v in request.args.items(multi=True) if k not in ("async","deadline","device")],
+        "environ_base":{"REMOTE_ADDR":request.remote_addr or "","udita.job":deadline}}
+    _job_pool(ip).submit(_job_run,j,ctx)
+    with _job_cond:out=_async_job_view(j)
+    return jsonify(out),202,{"Location":f"/api/jobs/{j['id']}"}
+
+@app.route("/api/jobs")
+def r_jobs():
+    dev=request.args.get("device")
+    with _job_cond:
+        for j in _jobs.values():_job_expire(j)
+        js=[_async_job_view(j) for j in _jobs.values() if not dev or j["device"]==dev]
+    return jsonify({"jobs":sorted(js,key=lambda j:j["created"]),"count":len(js)})
+
+@app.route("/api/jobs/<jid>",methods=["GET"])
+def r_job(jid):
+    """Job state and, once done, its JSON result. ?wait=s long-polls until the job finishes."""
+    try:wait=min(JOB_MAX_WAIT,max(0.0,float(request.args.get("wait",0))))
+    except ValueError:return jsonify({"error":"Invalid wait"}),400
+    end=time.time()+wait
+    with _job_cond:
+        j=_jobs.get(jid)
+        if not j:return jsonify({"error":"unknown or expired job"}),404
+        while True:
+            _job_expire(j)
+            left=min(end,j["deadline"] or end)-time.time()
+            if j["state"] in JOB_DONE or left<=0:break
+            _job_cond.wait(left)
+        return jsonify(_async_job_view(j)),200 if j["state"] in JOB_DONE else 202
+
+@app.route("/api/jobs/<jid>/result")
+def r_job_result(jid):
+    """The finished job's original response (status, content type, body)."""
+    with _job_cond:
+        j=_jobs.get(jid)
+        if not j:return jsonify({"error":"unknown or expired job"}),404
+        _job_expire(j)
+        if j["state"] not in JOB_DONE:return jsonify(_async_job_view(j)),202
+        if j.get("body") is None:return jsonify(_async_job_view(j)),410 if j["state"] in ("cancelled","expired") else 500
+        return Response(j["body"],status=j["status_code"],mimetype=j["mimetype"])
+
+@app.route("/api/jobs/<jid>/events")
+def r_job_events(jid):
+    """Server-sent events: the job's view on every state change, ending when it finishes."""
+    with _job_cond:
+        if jid not in _jobs:return jsonify({"error":"unknown or expired job"}),404
+    def stream():
+        last=None
+        while True:
+            with _job_cond:
+                j=_jobs.get(jid)
+                if not j:return
+                _job_expire(j)
+                if j["state"]==last:_job_cond.wait(15);_job_expire(j)
+                view=_async_job_view(j) if j["state"]!=last else None
+            if view:
+                last=view["state"];yield f"event: {last}\ndata: {json.dumps(view)}\n\n"
+                if last in JOB_DONE:return
+            else:yield ": keepalive\n\n"
+    return Response(stream(),mimetype="text/event-stream",headers={"Cache-Control":"no-cache"})
+
+@app.route("/api/jobs/<jid>",methods=["DELETE"])
+def r_job_cancel(jid):
+    with _job_cond:
+        j=_jobs.get(jid)
+        if not j:return jsonify({"error":"unknown or expired job"}),404
+        if j["state"] not in JOB_DONE:
+            j["state"]="cancelled";j["finished"]=time.time();_job_cond.notify_all()
+        return jsonify(_async_job_view(j))
+
+# ── Admission control ────────────────────────────────────────────────────────
+# Bounds what one phone is asked to do at once, so a script hammering
+# /api/source cannot starve the person tapping on the same device. Each device
+# has ADMIT_DEVICE request slots, ADMIT_RESERVE of them usable only by
+# interactive input, plus a limit per route class. Requests that find no slot
+# wait in a bounded per-class queue; waiting input is served before reads and
+# reads before heavy tree/media work. Full queues are refused with 429 and
+# waits past ADMIT_WAIT with 503, both with Retry-After and "X-Shed: 1" (not
+# executed, safe to resend; open breakers and missing shard workers say so too).
+
+ADMIT_DEVICE=int(os.environ.get("ADMIT_DEVICE","6"))  # requests in flight per device, all classes
+ADMIT_RESERVE=1  # device slots only interactive input may take
+ADMIT_PRIORITY=("input","read","heavy")
+ADMIT_LIMITS={"input":3,"read":4,"heavy":2}  # in flight per device and class
+ADMIT_QUEUE={"input":16,"read":8,"heavy":4}  # waiting per device and class before 429
+ADMIT_WAIT={"input":10.0,"read":3.0,"heavy":5.0}  # longest wait for a slot before 503 (s)
+ADMIT_HEAVY=re.compile(r"^/api/(source|accessible-source|elements|find|find-image|tap-image|click|wait-for|wait-stable|"
+    r"accessibility-audit|video(/.*)?|screenshot(\.png)?|launch|launch-unattached|siri|expect-notification|answer-call|decline-call)$"
+    r"|/(source|accessibleSource|screenshot|elements?|performAccessibilityAudit)$")
+ADMIT_EXEMPT=("/api/screen/stream",)  # long-lived; its captures go through single-flight
+_adm={}  # ip -> {"active":{cls:n},"waiting":{cls:n},"stats":{cls:{...}}}
+_adm_cond=threading.Condition()
+
+def _admit_class():
+    if ADMIT_HEAVY.search(request.path):return "heavy"
+    return "read" if request.method in ("GET","HEAD") else "input"
+
+def _adm_entry(ip):
+    a=_adm.get(ip)
+    if a is None:
+        a=_adm[ip]={"active":dict.fromkeys(ADMIT_PRIORITY,0),"waiting":dict.fromkeys(ADMIT_PRIORITY,0),
+            "stats":{c:{"admitted":0,"queued":0,"rejected":0,"timed_out":0,"wait_ms":0.0,"hold_ms":0.0} for c in ADMIT_PRIORITY}}
+    return a
+
+def _adm_free(a,cls):
+    act=a["active"]
+    if act[cls]>=ADMIT_LIMITS[cls]:return False
+    if sum(act.values())>=ADMIT_DEVICE-(0 if cls=="input" else ADMIT_RESERVE):return False
+    # A higher class held back only by device-wide capacity goes first
+    return not any(a["waiting"][h] and act[h]<ADMIT_LIMITS[h] for h in ADMIT_PRIORITY[:ADMIT_PRIORITY.index(cls)])
+
+def _adm_retry_after(a,cls):
+    """Seconds until a slot is likely: average hold time times the queue ahead, per slot."""
+    hold=a["stats"][cls]["hold_ms"]/1000 or 0.5
+    return max(1,int(hold*(a["waiting"][cls]+1)/ADMIT_LIMITS[cls]+0.999))
+
+@app.before_request
+def _admit():
+    if request.method=="OPTIONS" or not request.path.startswith(("/api/","/wda/")) or request.path.startswith(FLEET_ROUTES+ADMIT_EXEMPT):return None
+    ip=_target()
+    if not ip:return None
+    cls=_admit_class();t0=time.monotonic();err=None
+    job="udita.job" in request.environ  # job replays are bounded by the job queue and wait until their own deadline
+    with _adm_cond:
+        a=_adm_entry(ip);st=a["stats"][cls]
+        if not _adm_free(a,cls):
+            if a["waiting"][cls]>=ADMIT_QUEUE[cls] and not job:
+                st["rejected"]+=1;err=(429,"too many queued requests",_adm_retry_after(a,cls))
+            else:
+                st["queued"]+=1;a["waiting"][cls]+=1
+                dl=request.environ["udita.job"] if job else time.time()+ADMIT_WAIT[cls]
+                try:
+                    while not _adm_free(a,cls):
+                        left=dl-time.time() if dl else None
+                        if left is not None and left<=0:
+                            st["timed_out"]+=1;err=(503,"timed out waiting for the device",_adm_retry_after(a,cls));break
+                        _adm_cond.wait(left)
+                finally:
+                    a["waiting"][cls]-=1;_adm_cond.notify_all()
+        if not err:
+            a["active"][cls]+=1;st["admitted"]+=1
+            st["wait_ms"]=st["wait_ms"]*0.9+(time.monotonic()-t0)*100  # EWMA, 0.1 * ms
+    if err:
+        code,msg,retry=err
+        return jsonify({"error":f"{ip} busy: {msg}","class":cls,"retry_after":retry}),code,{"Retry-After":str(retry),"X-Shed":"1"}
+    g.admitted=(ip,cls,time.monotonic())
+    return None
+
+@app.after_request
+def _admit_hold(resp):
+    """Streamed bodies (passthrough, proxied responses) keep their slot until the last byte is sent."""
+    if resp.is_streamed and "admitted" in g:resp.response=_AdmitHeld(resp.response,g.pop("admitted"))
+    return resp
+
+class _AdmitHeld:
+    """Response body that frees its admission slot on close(), which the server calls even if the body was never read (HEAD, early disconnect)."""
+    def __init__(self,body,adm):self.body,self.adm=body,adm
+    def __iter__(self):return iter(self.body)
+    def close(self):
+        adm,self.adm=self.adm,None
+        try:
+            if hasattr(self.body,"close"):self.body.close()
+        finally:
+            if adm:_admit_free(adm)
+
+@app.teardown_request
+def _admit_release(exc=None):
+    adm=g.pop("admitted",None)
+    if adm:_admit_free(adm)
+
+def _admit_free(adm):
+    ip,cls,t=adm
+    with _adm_cond:
+        a=_adm_entry(ip);a["active"][cls]-=1
+        st=a["stats"][cls];st["hold_ms"]=st["hold_ms"]*0.9+(time.monotonic()-t)*100
+        _adm_cond.notify_all()
+
+@app.route("/api/admission")
+def r_admission():
+    """In-flight and queued requests per device and class, with admission counters and average wait/hold times."""
+    with _adm_cond:
+        devs={ip:{"active":dict(a["active"]),"waiting":dict(a["waiting"]),
+            "classes":{c:dict(s,wait_ms=round(s["wait_ms"],1),hold_ms=round(s["hold_ms"],1)) for c,s in a["stats"].items()}}
+            for ip,a in _adm.items()}
+    return jsonify({"devices":devs,"limits":{"device":ADMIT_DEVICE,"reserved_for_input":ADMIT_RESERVE,
+        "classes":{c:{"in_flight":ADMIT_LIMITS[c],"queue":ADMIT_QUEUE[c],"max_wait":ADMIT_WAIT[c]} for c in ADMIT_PRIORITY}}})
+
 # Touch
 @app.route("/api/tap",methods=["POST"])
 def r_tap():
@@ -254,11 +1538,19 @@ def r_drag():
     }) if s else {"error":"no session"}
     ev("drag",d);return jsonify({"status":"ok","wda":r})
 
+def _xy_or_center(d):
+    """x/y from the request body, defaulting to the centre of the target device's screen."""
+    x,y=d.get("x"),d.get("y")
+    if x is None or y is None:
+        ww,hh=_screen_size()
+        x=ww//2 if x is None else x;y=hh//2 if y is None else y
+    return {"x":x,"y":y}
+
 @app.route("/api/pinch",methods=["POST"])
 def r_pinch():
     d=request.get_json(force=True,silent=True) or {}
     s=sid()
-    r=w("POST",f"/session/{s}/wda/pinch",{"scale":d.get("scale",0.5),"velocity":d.get("velocity",-2),"x":d.get("x",DW//2),"y":d.get("y",DH//2)}) if s else {"error":"no session"}
+    r=w("POST",f"/session/{s}/wda/pinch",{"scale":d.get("scale",0.5),"velocity":d.get("velocity",-2),**_xy_or_center(d)}) if s else {"error":"no session"}
     ev("pinch",d);return jsonify({"status":"ok","wda":r})
 
 @app.route("/api/rotate",methods=["POST"])
@@ -266,7 +1558,7 @@ def r_rotate():
     d=request.get_json(force=True,silent=True) or {}
     s=sid()
     r=w("POST",f"/session/{s}/wda/rotate",d) if s else {"error":"no session"}
-    ev("rotate",d);return jsonify({"status":"ok","wda":r})
+    _meta_invalidate(_target(),"size","screen","orientation");ev("rotate",d);return jsonify({"status":"ok","wda":r})
 
 @app.route("/api/scroll",methods=["POST"])
 def r_scroll():
@@ -279,14 +1571,14 @@ def r_scroll():
 def r_2ft():
     d=request.get_json(force=True,silent=True) or {}
     s=sid()
-    r=w("POST",f"/session/{s}/wda/twoFingerTap",{"x":d.get("x",DW//2),"y":d.get("y",DH//2)}) if s else {"error":"no session"}
+    r=w("POST",f"/session/{s}/wda/twoFingerTap",_xy_or_center(d)) if s else {"error":"no session"}
     ev("two_finger_tap",d);return jsonify({"status":"ok","wda":r})
 
 @app.route("/api/multi-tap",methods=["POST"])
 def r_mt():
     d=request.get_json(force=True,silent=True) or {}
     s=sid()
-    r=w("POST",f"/session/{s}/wda/tapWithNumberOfTaps",{"x":d.get("x",DW//2),"y":d.get("y",DH//2),"numberOfTaps":d.get("taps",2),"numberOfTouches":d.get("touches",1)}) if s else {"error":"no session"}
+    r=w("POST",f"/session/{s}/wda/tapWithNumberOfTaps",{**_xy_or_center(d),"numberOfTaps":d.get("taps",2),"numberOfTouches":d.get("touches",1)}) if s else {"error":"no session"}
     ev("multi_tap",d);return jsonify({"status":"ok","wda":r})
 
 @app.route("/api/force-touch",methods=["POST"])
@@ -332,17 +1624,18 @@ def r_unlock():
 
 @app.route("/api/locked")
 def r_locked():
-    s=sid();r=w("GET",f"/session/{s}/wda/locked") if s else w("GET","/wda/locked")
+    s=sid();r=w("GET",f"/session/{s}/wda/locked",coalesce=True) if s else w("GET","/wda/locked",coalesce=True)
     return jsonify(r)
 
 @app.route("/api/orientation",methods=["GET"])
 def r_orient():
-    s=sid();return jsonify(w("GET",f"/session/{s}/orientation") if s else {})
+    r=_meta_get("orientation");return jsonify({} if r.get("error")=="no session" else r)
 
 @app.route("/api/orientation",methods=["POST"])
 def r_set_orient():
     d=request.get_json(force=True,silent=True) or {};s=sid()
-    return jsonify(w("POST",f"/session/{s}/orientation",d) if s else {})
+    r=w("POST",f"/session/{s}/orientation",d) if s else {}
+    _meta_invalidate(_target(),"size","screen","orientation");return jsonify(r)
 
 @app.route("/api/rotation",methods=["GET"])
 def r_rot():
@@ -351,15 +1644,13 @@ def r_rot():
 @app.route("/api/rotation",methods=["POST"])
 def r_set_rot():
     d=request.get_json(force=True,silent=True) or {};s=sid()
-    return jsonify(w("POST",f"/session/{s}/rotation",d) if s else {})
+    r=w("POST",f"/session/{s}/rotation",d) if s else {}
+    _meta_invalidate(_target(),"size","screen","orientation");return jsonify(r)
 
 @app.route("/api/battery")
 def r_batt():
     """Battery info from WDA. level is 0.0–1.0 (UIDevice.batteryLevel); we add percentage 0–100."""
-    s=sid()
-    if not s:
-        return jsonify({"error":"no session"})
-    raw=w("GET",f"/session/{s}/wda/batteryInfo")
+    raw=_meta_get("battery")
     if not isinstance(raw,dict):
         return jsonify(raw if raw else {})
     if raw.get("error"):
@@ -393,15 +1684,15 @@ def r_batt():
 
 @app.route("/api/device-info")
 def r_devinfo():
-    s=sid();return jsonify(w("GET",f"/session/{s}/wda/device/info") if s else w("GET","/wda/device/info"))
+    return jsonify(_meta_get("device_info"))
 
 @app.route("/api/active-app")
 def r_activeapp():
-    s=sid();return jsonify(w("GET",f"/session/{s}/wda/activeAppInfo") if s else w("GET","/wda/activeAppInfo"))
+    return jsonify(_meta_get("active_app"))
 
 @app.route("/api/screen-info")
 def r_screeninfo():
-    s=sid();return jsonify(w("GET",f"/session/{s}/wda/screen") if s else w("GET","/wda/screen"))
+    return jsonify(_meta_get("screen"))
 
 # Keyboard
 @app.route("/api/type",methods=["POST"])
@@ -631,12 +1922,14 @@ def r_applist():
 @app.route("/api/deactivate-app",methods=["POST"])
 def r_deactivate():
     d=request.get_json(force=True,silent=True) or {};s=sid()
-    return jsonify(w("POST",f"/session/{s}/wda/deactivateApp",d) if s else {})
+    r=w("POST",f"/session/{s}/wda/deactivateApp",d) if s else {}
+    _meta_invalidate(_target(),"active_app");return jsonify(r)
 
 @app.route("/api/open-url",methods=["POST"])
 def r_openurl():
     d=request.get_json(force=True,silent=True) or {};s=sid()
-    return jsonify(w("POST",f"/session/{s}/url",{"url":d.get("url","")}) if s else {})
+    r=w("POST",f"/session/{s}/url",{"url":d.get("url","")}) if s else {}
+    _meta_invalidate(_target(),"active_app");return jsonify(r)
 
 # Elements
 @app.route("/api/click",methods=["POST"])
@@ -687,7 +1980,7 @@ def r_decline():
 @app.route("/api/screenshot")
 def r_ss():
     s=sid()
-    r=w("GET",f"/session/{s}/screenshot") if s else w("GET","/screenshot")
+    r=w("GET",f"/session/{s}/screenshot",coalesce=True) if s else w("GET","/screenshot",coalesce=True)
     b64=r.get("value","")
     if b64:return jsonify({"status":"ok","base64":b64})
     return jsonify({"error":"failed"}),500
@@ -695,34 +1988,445 @@ def r_ss():
 @app.route("/api/screenshot.png")
 def r_ss_png():
     s=sid()
-    r=w("GET",f"/session/{s}/screenshot") if s else w("GET","/screenshot")
+    r=w("GET",f"/session/{s}/screenshot",coalesce=True) if s else w("GET","/screenshot",coalesce=True)
     b64=r.get("value","")
     if b64:return Response(base64.b64decode(b64),mimetype="image/png")
     return "Failed",500
 
+# ── Screen stability ─────────────────────────────────────────────────────────
+# Poll screenshots and compare downscaled grayscale frames so clients can wait
+# for animations to settle instead of padding every action with sleeps.
+
+STABLE_THUMB_W=96  # thumbnail width used for frame comparison
+
+def _grab_frame(ip=None):
+    """Current screenshot as a PIL image, or None if WDA did not return one."""
+    s=sid(ip)
+    r=w("GET",f"/session/{s}/screenshot",ip=ip,coalesce=True) if s else w("GET","/screenshot",ip=ip,coalesce=True)
+    b64=r.get("value","") if isinstance(r,dict) else ""
+    if not b64 or not isinstance(b64,str):return None
+    try:return Image.open(io.BytesIO(base64.b64decode(b64)))
+    except Exception:return None
+
+def _thumb(img):
+    ww,hh=img.size
+    return img.convert("L").resize((STABLE_THUMB_W,max(1,hh*STABLE_THUMB_W//ww)),Image.BOX)
+
+def _changed_pct(a,b,threshold):
+    """Percent of thumbnail pixels whose gray level differs by more than threshold."""
+    if a.size!=b.size:return 100.0
+    hist=ImageChops.difference(a,b).histogram()
+    return 100.0*sum(hist[threshold+1:])/(a.size[0]*a.size[1])
+
+@app.route("/api/wait-stable",methods=["POST"])
+def r_wait_stable():
+    """Block until `frames` consecutive screenshots match within `tolerance` (% changed pixels) or `timeout` (s)."""
+    d=request.get_json(force=True,silent=True) or {}
+    try:
+        need=max(2,int(d.get("frames",3)))
+        tol=float(d.get("tolerance",0.1))
+        thr=min(254,max(0,int(d.get("threshold",12))))
+        timeout=float(d.get("timeout",10))
+        interval=max(0.0,float(d.get("interval",0)))
+    except (TypeError,ValueError):return jsonify({"error":"Invalid frames/tolerance/threshold/timeout/interval"}),400
+    t0=time.monotonic();deadline=t0+timeout
+    anchor=None;anchor_t=t0;run=0;n=0;last=None
+    while True:
+        img=_grab_frame()
+        now=time.monotonic()
+        if img is None:
+            if anchor is None:return jsonify({"error":"screenshot failed"}),500
+        else:
+            n+=1;th=_thumb(img)
+            if anchor is not None:last=_changed_pct(anchor,th,thr)
+            if anchor is None or last>tol:anchor,anchor_t,run=th,now,1
+            else:run+=1
+            if run>=need:
+                ev("wait_stable",{"settled_ms":int((anchor_t-t0)*1000)})
+                return jsonify({"status":"stable","stable":True,"settled_ms":int((anchor_t-t0)*1000),
+                    "elapsed_ms":int((now-t0)*1000),"frames":n,"changed_pct":last})
+        if now+interval>=deadline:break
+        if interval:time.sleep(interval)
+    return jsonify({"status":"timeout","stable":False,"settled_ms":None,
+        "elapsed_ms":int((time.monotonic()-t0)*1000),"frames":n,"changed_pct":last})
+
 # Source/elements
 @app.route("/api/source")
 def r_src():
-    s=sid();return jsonify(w("GET",f"/session/{s}/source") if s else w("GET","/source"))
+    s=sid();return jsonify(w("GET",f"/session/{s}/source",coalesce=True) if s else w("GET","/source",coalesce=True))
 
 @app.route("/api/accessible-source")
 def r_asrc():
-    s=sid();return jsonify(w("GET",f"/session/{s}/wda/accessibleSource") if s else {})
+    s=sid();return jsonify(w("GET",f"/session/{s}/wda/accessibleSource",coalesce=True) if s else {})
 
 @app.route("/api/elements")
 def r_els():
     s=sid()
     if not s:return jsonify({"elements":[],"count":0})
-    xml=(w("GET",f"/session/{s}/source") or {}).get("value","")
-    vis=[]
-    for m in re.finditer(r'<(\w+)\s+([^>]+?)/?>', xml):
-        a=dict(re.findall(r'(\w+)="([^"]*)"',m.group(2)))
-        n=a.get("name") or a.get("label") or ""
-        x,y,ww,h=int(a.get("x","0")),int(a.get("y","0")),int(a.get("width","0")),int(a.get("height","0"))
-        if ww>0 and h>0 and n:
-            vis.append({"type":(a.get("type","")).replace("XCUIElementType",""),"name":n,"x":x,"y":y,"w":ww,"h":h,"cx":x+ww//2,"cy":y+h//2})
+    xml=(w("GET",f"/session/{s}/source",coalesce=True) or {}).get("value","")
+    vis=[{k:e[k] for k in ("type","name","x","y","w","h","cx","cy")} for e in _parse_source(xml) if e["w"]>0 and e["h"]>0 and e["name"]]
     return jsonify({"elements":vis[:100],"count":len(vis)})
 
+def _parse_source(xml):
+    """Flatten WDA XML source into element dicts (name falls back to label)."""
+    out=[]
+    for m in re.finditer(r'<(\w+)\s+([^>]+?)/?>', xml if isinstance(xml,str) else ""):
+        a=dict(re.findall(r'(\w+)="([^"]*)"',m.group(2)))
+        try:x,y,ww,h=int(a.get("x","0")),int(a.get("y","0")),int(a.get("width","0")),int(a.get("height","0"))
+        except ValueError:continue
+        out.append({"type":(a.get("type","")).replace("XCUIElementType",""),"name":a.get("name") or a.get("label") or "",
+            "label":a.get("label",""),"enabled":a.get("enabled")=="true","visible":a.get("visible")=="true",
+            "x":x,"y":y,"w":ww,"h":h,"cx":x+ww//2,"cy":y+h//2})
+    return out
+
+# ── Tile-delta screen stream ─────────────────────────────────────────────────
+# Live view: one keyframe, then only the tiles that changed since the previous
+# frame, pushed as server-sent events. The whole-frame difference bbox (Pillow,
+# C-level) bounds the search so only tiles inside it are checked. A reconnect
+# is a resync and starts with a keyframe; so do size changes (rotation) and
+# frames where most tiles changed.
+
+STREAM_TILE=int(os.environ.get("STREAM_TILE","64"))  # tile edge in (scaled) pixels
+STREAM_KEYFRAME=30  # seconds between forced keyframes
+STREAM_FULL_RATIO=0.5  # send a keyframe instead once this share of tiles changed
+
+def _encode_b64(img,fmt,quality):
+    b=io.BytesIO()
+    if fmt=="JPEG":img.save(b,format=fmt,quality=quality)
+    else:img.save(b,format=fmt)
+    return base64.b64encode(b.getvalue()).decode()
+
+def _changed_tiles(prev,cur,tile):
+    """Boxes of the tile grid where cur differs from prev."""
+    diff=ImageChops.difference(prev,cur)
+    box=diff.getbbox()
+    if not box:return []
+    out=[]
+    for y in range(box[1]//tile*tile,box[3],tile):
+        for x in range(box[0]//tile*tile,box[2],tile):
+            b=(x,y,min(x+tile,cur.width),min(y+tile,cur.height))
+            if diff.crop(b).getbbox():out.append(b)
+    return out
+
+@app.route("/api/screen/stream")
+def r_screen_stream():
+    """Server-sent "key" ({width,height,img}) and "delta" ({tiles:[[x,y,img],...]}) events. ?fps=&scale=&quality=&tile=&format=jpeg|png"""
+    try:
+        fps=min(15.0,max(0.2,float(request.args.get("fps",4))))
+        scale=min(1.0,max(0.1,float(request.args.get("scale",0.5))))
+        quality=min(95,max(10,int(request.args.get("quality",70))))
+        tile=max(16,int(request.args.get("tile",STREAM_TILE)))
+    except ValueError:return jsonify({"error":"Invalid fps/scale/quality/tile"}),400
+    fmt="PNG" if request.args.get("format","").lower()=="png" else "JPEG"
+    mime="image/png" if fmt=="PNG" else "image/jpeg"
+    ip=_target()
+    if not ip:return jsonify({"error":"no device selected"}),400
+    def sse(kind,d):return f"event: {kind}\ndata: {json.dumps(d)}\n\n"
+    def stream():
+        prev=None;seq=0;key_t=0.0;sent_t=time.monotonic()
+        while True:
+            t0=time.monotonic()
+            img=_grab_frame(ip)
+            if img is not None:
+                img=img.convert("RGB")
+                if scale<1:img=img.resize((max(1,int(img.width*scale)),max(1,int(img.height*scale))),Image.BILINEAR)
+                total=-(-img.width//tile)*-(-img.height//tile)
+                tiles=None if prev is None or prev.size!=img.size or t0-key_t>=STREAM_KEYFRAME else _changed_tiles(prev,img,tile)
+                if tiles is None or len(tiles)>=STREAM_FULL_RATIO*total:
+                    seq+=1;key_t=sent_t=t0
+                    yield sse("key",{"seq":seq,"width":img.width,"height":img.height,"mime":mime,"img":_encode_b64(img,fmt,quality)})
+                elif tiles:
+                    seq+=1;sent_t=t0
+                    yield sse("delta",{"seq":seq,"mime":mime,"tiles":[[b[0],b[1],_encode_b64(img.crop(b),fmt,quality)] for b in tiles]})
+                prev=img
+            if t0-sent_t>=15:sent_t=t0;yield ": keepalive\n\n"
+            time.sleep(max(0.0,1/fps-(time.monotonic()-t0)))
+    return Response(stream(),mimetype="text/event-stream",headers={"Cache-Control":"no-cache","X-Accel-Buffering":"no"})
+
+# ── Image templates ──────────────────────────────────────────────────────────
+# Locate UI by picture when there is no accessibility tree (games, canvases,
+# WebViews). Templates are uploaded once (or cropped from the live screen),
+# stored in STATE_DIR/templates and kept in memory as a grayscale pyramid over
+# TEMPLATE_SCALES. Matching is zero-mean normalized cross-correlation via FFT
+# on a downscaled screenshot, then refined at full resolution around each hit.
+# Needs numpy; without it the endpoints answer 501.
+
+try:import numpy as np
+except ImportError:np=None
+
+TEMPLATE_DIR=STATE_DIR/"templates"
+TEMPLATE_SCALES=(0.5,0.67,0.75,1.0,1.25,1.5,2.0)  # template size relative to its source screenshot
+MATCH_WIDTH=240  # screenshot width (px) for the coarse search
+MATCH_MIN_SIDE=12  # smallest template side (px) worth searching at coarse resolution
+FRAME_MAX_AGE=0.25  # seconds a grayscale screenshot may be reused
+_templates={}  # name -> {"img":PIL L image,"pyramid":{scale:array},"coarse":{(scale,f):(array,norm)}}
+_tpl_lock=threading.Lock()
+_frames={}  # ip -> (monotonic ts, full-res gray array, {coarse factor: _ncc_prep})
+_frame_lock=threading.Lock()
+
+def _tpl_add(name,img):
+    """Register a template image and precompute its pyramid."""
+    g=img.convert("L");pyr={}
+    for sc in TEMPLATE_SCALES:
+        tw,th=max(1,round(g.width*sc)),max(1,round(g.height*sc))
+        pyr[sc]=np.asarray(g if sc==1 else g.resize((tw,th),Image.LANCZOS),dtype=np.float32)
+    with _tpl_lock:_templates[name]={"img":g,"pyramid":pyr,"coarse":{}}
+
+def _tpl_load():
+    if np is None or not TEMPLATE_DIR.is_dir():return
+    for p in TEMPLATE_DIR.glob("*.png"):
+        try:_tpl_add(p.stem,Image.open(p))
+        except Exception as e:log.warning(f"Template {p.name} not loaded: {e}")
+    if _templates:log.info(f"Templates: {len(_templates)} loaded")
+
+def _tpl_sync(name):
+    """Reload one template from TEMPLATE_DIR, or forget it if the file is gone."""
+    if np is None or not re.fullmatch(r"[A-Za-z0-9_.-]{1,64}",name):return
+    try:_tpl_add(name,Image.open(TEMPLATE_DIR/f"{name}.png"))
+    except FileNotFoundError:
+        with _tpl_lock:_templates.pop(name,None)
+    except Exception as e:log.warning(f"Template {name} not loaded: {e}")
+
+def _gray_frame(ip):
+    """(gray float array, coarse cache) of the device's current screen, shared for FRAME_MAX_AGE."""
+    with _frame_lock:hit=_frames.get(ip)
+    if hit and time.monotonic()-hit[0]<=FRAME_MAX_AGE:return hit[1:]
+    img=_grab_frame(ip)
+    if img is None:return None
+    hit=(time.monotonic(),np.asarray(img.convert("L"),dtype=np.float32),{})
+    with _frame_lock:_frames[ip]=hit
+    return hit[1:]
+
+def _resize(a,f):
+    h,w=a.shape
+    return np.asarray(Image.fromarray(a).resize((max(1,round(w*f)),max(1,round(h*f))),Image.BILINEAR),dtype=np.float32)
+
+def _ncc_prep(img):
+    """Per-image parts of the ZNCC (spectrum, integral images) shared by every template tried on it."""
+    c=np.pad(img.astype(np.float64),((1,0),(1,0)))
+    return {"img":img,"F":np.fft.rfft2(img),"c":c.cumsum(0).cumsum(1),"c2":(c*c).cumsum(0).cumsum(1)}
+
+def _ncc(p,tpl):
+    """ZNCC score map (valid positions) of tpl over a prepared image."""
+    img=p["img"];H,W=img.shape;h,w=tpl.shape
+    if h>H or w>W:return None
+    t=tpl-tpl.mean();tn=float(np.sqrt((t*t).sum()))
+    if tn<1e-6:return None  # flat template matches everything
+    corr=np.fft.irfft2(p["F"]*np.conj(np.fft.rfft2(t,img.shape)),img.shape)[:H-h+1,:W-w+1]
+    def win(c):return c[h:,w:]-c[:-h,w:]-c[h:,:-w]+c[:-h,:-w]
+    s=win(p["c"]);var=np.maximum(win(p["c2"])-s*s/(h*w),0)
+    return np.where(var>1e-3,corr/(np.sqrt(var)*tn+1e-9),0)
+
+def _peaks(score,h,w,threshold,limit):
+    """Best positions in a score map, suppressing neighbours within half a template."""
+    out=[];sc=score.copy()
+    while len(out)<limit:
+        y,x=np.unravel_index(int(sc.argmax()),sc.shape)
+        v=float(sc[y,x])
+        if v<threshold:break
+        out.append((v,int(x),int(y)))
+        sc[max(0,y-h//2):y+h//2+1,max(0,x-w//2):x+w//2+1]=-1
+    return out
+
+def _overlap(a,b):
+    """Intersection area of two (x,y,w,h) boxes."""
+    return max(0,min(a[0]+a[2],b[0]+b[2])-max(a[0],b[0]))*max(0,min(a[1]+a[3],b[1]+b[3])-max(a[1],b[1]))
+
+def _find_template(ip,name,threshold,limit):
+    """Matches as dicts in screen points, best first; None if no screenshot."""
+    with _tpl_lock:t=_templates.get(name)
+    got=_gray_frame(ip) if t else None
+    if got is None:return None
+    frame,coarse=got;H,W=frame.shape
+    side=min(t["img"].size)*min(TEMPLATE_SCALES)
+    f=round(min(1.0,max(MATCH_WIDTH/W,MATCH_MIN_SIDE/max(1,side))),4)
+    small=coarse.get(f)
+    if small is None:small=coarse[f]=_ncc_prep(_resize(frame,f) if f<1 else frame)
+    peaks=[]
+    for sc,full in t["pyramid"].items():
+        if full.shape[0]>H or full.shape[1]>W:continue
+        tpl=t["coarse"].get((sc,f))
+        if tpl is None:tpl=t["coarse"][(sc,f)]=_resize(full,f) if f<1 else full
+        score=_ncc(small,tpl)
+        if score is not None:peaks+=[(v,sc,x,y) for v,x,y in _peaks(score,*tpl.shape,threshold*0.85,limit)]  # coarse scores run a little low
+    cands=[]
+    for _,sc,x,y in sorted(peaks,reverse=True)[:2*limit+2]:
+        # Refine the strongest coarse hits at full resolution, +-2 coarse pixels around each
+        full=t["pyramid"][sc];th,tw=full.shape
+        m=int(round(2/f))+1;x0=max(0,int(x/f)-m);y0=max(0,int(y/f)-m)
+        fine=_ncc(_ncc_prep(frame[y0:min(H,int(y/f)+m+th),x0:min(W,int(x/f)+m+tw)]),full)
+        if fine is None:continue
+        fy,fx=np.unravel_index(int(fine.argmax()),fine.shape)
+        v=float(fine[fy,fx])
+        if v>=threshold:cands.append((v,sc,x0+int(fx),y0+int(fy),tw,th))
+    cands.sort(reverse=True);kept=[]
+    for c in cands:  # drop hits overlapping a better one (neighbouring scales find the same spot)
+        if all(_overlap(c[2:],k[2:])<0.3*min(c[4]*c[5],k[4]*k[5]) for k in kept):kept.append(c)
+        if len(kept)>=limit:break
+    ww,_=_screen_size(ip);k=ww/W  # pixels -> points
+    return [{"x":round(x*k),"y":round(y*k),"w":round(tw*k),"h":round(th*k),"cx":round((x+tw/2)*k),"cy":round((y+th/2)*k),
+        "score":round(v,4),"scale":sc} for v,sc,x,y,tw,th in kept]
+
+def _match_args(d):
+    name=d.get("template") or d.get("name") or ""
+    with _tpl_lock:known=name in _templates
+    if not known:return None,(jsonify({"error":f"unknown template '{name}'"}),404)
+    try:return (name,min(1.0,max(0.0,float(d.get("threshold",0.8)))),max(1,min(50,int(d.get("max_results",5))))),None
+    except (TypeError,ValueError):return None,(jsonify({"error":"Invalid threshold/max_results"}),400)
+
+def _no_numpy():
+    return jsonify({"error":"image matching needs numpy (pip install numpy)"}),501
+
+@app.route("/api/templates",methods=["GET"])
+def r_templates():
+    with _tpl_lock:out=[{"name":n,"width":t["img"].width,"height":t["img"].height} for n,t in sorted(_templates.items())]
+    return jsonify({"templates":out,"scales":list(TEMPLATE_SCALES),"available":np is not None})
+
+@app.route("/api/templates",methods=["POST"])
+def r_template_add():
+    """Add a template: {"name","image":base64 PNG/JPEG} or {"name","device","rect":{x,y,w,h}} (points) to crop the live screen."""
+    if np is None:return _no_numpy()
+    d=request.get_json(force=True,silent=True) or {}
+    name=str(d.get("name") or "")
+    if not re.fullmatch(r"[A-Za-z0-9_.-]{1,64}",name):return jsonify({"error":"name must be 1-64 of A-Z a-z 0-9 _ . -"}),400
+    try:
+        if d.get("image"):img=Image.open(io.BytesIO(base64.b64decode(d["image"])));img.load()
+        elif isinstance(d.get("rect"),dict):
+            ip=(d.get("device") or request.headers.get("X-Device") or "").strip() or IPHONE_IP
+            full=_grab_frame(ip) if ip else None
+            if full is None:return jsonify({"error":"screenshot failed"}),500
+            k=full.width/_screen_size(ip)[0];r=d["rect"]
+            img=full.crop(tuple(int(round(float(v)*k)) for v in (r["x"],r["y"],r["x"]+r["w"],r["y"]+r["h"])))
+        else:return jsonify({"error":"Missing image or rect"}),400
+    except Exception as e:return jsonify({"error":f"Invalid image: {e}"}),400
+    if min(img.size)<4:return jsonify({"error":"template too small"}),400
+    TEMPLATE_DIR.mkdir(parents=True,exist_ok=True)
+    img.convert("L").save(TEMPLATE_DIR/f"{name}.png")
+    _tpl_add(name,img)
+    return jsonify({"status":"ok","name":name,"width":img.width,"height":img.height})
+
+@app.route("/api/templates/<name>",methods=["DELETE"])
+def r_template_del(name):
+    with _tpl_lock:t=_templates.pop(name,None)
+    if not t:return jsonify({"error":f"unknown template '{name}'"}),404
+    try:(TEMPLATE_DIR/f"{name}.png").unlink()
+    except OSError:pass
+    return jsonify({"status":"ok"})
+
+@app.route("/api/find-image",methods=["POST"])
+def r_find_image():
+    """Match a template against the current screen: {"template","threshold":0.8,"max_results":5}. Rects are in points."""
+    if np is None:return _no_numpy()
+    args,err=_match_args(request.get_json(force=True,silent=True) or {})
+    if err:return err
+    t0=time.monotonic();ms=_find_template(_target(),*args)
+    if ms is None:return jsonify({"error":"screenshot failed"}),500
+    return jsonify({"matches":ms,"count":len(ms),"elapsed_ms":int((time.monotonic()-t0)*1000)})
+
+@app.route("/api/tap-image",methods=["POST"])
+def r_tap_image():
+    """Tap the centre of the best match for a template."""
+    if np is None:return _no_numpy()
+    args,err=_match_args(request.get_json(force=True,silent=True) or {})
+    if err:return err
+    t0=time.monotonic();ms=_find_template(_target(),args[0],args[1],1)
+    if ms is None:return jsonify({"error":"screenshot failed"}),500
+    if not ms:return jsonify({"error":f"'{args[0]}' not on screen","matched":False}),404
+    m=ms[0];s=sid()
+    r=w("POST",f"/session/{s}/wda/tap",{"x":m["cx"],"y":m["cy"]}) if s else {"error":"no session"}
+    ev("tap_image",{"template":args[0],"x":m["cx"],"y":m["cy"],"score":m["score"]})
+    return jsonify({"status":"ok","matched":True,"match":m,"elapsed_ms":int((time.monotonic()-t0)*1000),"wda":r})
+
+# ── Wait for element ─────────────────────────────────────────────────────────
+# Server-side polling with backoff. Name/type locators are evaluated against a
+# short-lived source snapshot shared by all concurrent waiters; predicate
+# locators go to WDA's predicate search.
+
+WAIT_CONDITIONS=("exists","gone","enabled","visible")
+SNAPSHOT_MAX_AGE=0.25  # seconds a source snapshot may be reused
+_snapshots={}  # ip -> (monotonic ts, [element dicts])
+_snap_lock=threading.Lock()
+_snap_locks={}  # ip -> lock so concurrent waiters share one source fetch
+
+def _invalidate_snapshots(ip=None):
+    with _snap_lock:
+        if ip:_snapshots.pop(ip,None)
+        else:_snapshots.clear()
+    with _frame_lock:
+        if ip:_frames.pop(ip,None)
+        else:_frames.clear()
+
+def _source_snapshot(max_age=SNAPSHOT_MAX_AGE):
+    """Parsed source of the target device, reusing a recent snapshot when possible."""
+    key=_target()
+    with _snap_lock:lk=_snap_locks.setdefault(key,threading.Lock())
+    with lk:
+        with _snap_lock:hit=_snapshots.get(key)
+        if hit and time.monotonic()-hit[0]<=max_age:return hit[1]
+        s=sid()
+        if not s:return None
+        r=w("GET",f"/session/{s}/source",coalesce=True)
+        if not isinstance(r,dict) or r.get("error") or not isinstance(r.get("value"),str):return None
+        els=_parse_source(r["value"])
+        with _snap_lock:_snapshots[key]=(time.monotonic(),els)
+        return els
+
+def _match_snapshot(els,name,typ,cond):
+    hits=[e for e in els if (not name or name in (e["name"],e["label"])) and (not typ or e["type"]==typ)]
+    if cond=="enabled":hits=[e for e in hits if e["enabled"]]
+    elif cond=="visible":hits=[e for e in hits if e["visible"]]
+    return hits
+
+def _pred_quote(v):
+    return '"'+str(v).replace("\\","\\\\").replace('"','\\"')+'"'
+
+def _match_predicate(s,pred,name,typ,cond):
+    parts=[f"({pred})"]
+    if name:parts.append(f"(name == {_pred_quote(name)} OR label == {_pred_quote(name)})")
+    if typ:parts.append(f"type == {_pred_quote('XCUIElementType'+typ)}")
+    if cond=="enabled":parts.append("enabled == 1")
+    elif cond=="visible":parts.append("visible == 1")
+    r=w("POST",f"/session/{s}/elements",{"using":"predicate string","value":" AND ".join(parts)})
+    if not isinstance(r,dict) or r.get("error") or not isinstance(r.get("value"),list):return None
+    return [{"id":e.get("ELEMENT") or e.get("element-6066-11e4-a52e-4f735466cecf")} for e in r["value"] if isinstance(e,dict)]
+
+@app.route("/api/wait-for",methods=["POST"])
+def r_wait_for():
+    """Wait until an element matching name/type/predicate satisfies `condition` or `timeout` (s) expires."""
+    d=request.get_json(force=True,silent=True) or {}
+    name=d.get("name") or "";pred=d.get("predicate") or ""
+    typ=(d.get("type") or "").replace("XCUIElementType","")
+    cond=d.get("condition","exists")
+    if not (name or typ or pred):return jsonify({"error":"Missing name, type or predicate"}),400
+    if cond not in WAIT_CONDITIONS:return jsonify({"error":f"condition must be one of {', '.join(WAIT_CONDITIONS)}"}),400
+    try:
+        timeout=float(d.get("timeout",10))
+        delay=max(0.02,float(d.get("interval",0.05)))
+        max_delay=max(delay,float(d.get("max_interval",1.0)))
+    except (TypeError,ValueError):return jsonify({"error":"Invalid timeout/interval"}),400
+    s=sid() if pred else None
+    if pred and not s:return jsonify({"error":"no session"})
+    t0=time.monotonic();deadline=t0+timeout;polls=0;hits=None
+    while True:
+        polls+=1
+        if pred:hits=_match_predicate(s,pred,name,typ,cond)
+        else:
+            els=_source_snapshot()
+            hits=None if els is None else _match_snapshot(els,name,typ,"exists" if cond=="gone" else cond)
+        if hits is not None and (not hits if cond=="gone" else hits):
+            el=None if cond=="gone" else hits[0]
+            if el and el.get("id"):el=dict(el,rect=(w("GET",f"/session/{s}/element/{el['id']}/rect") or {}).get("value"))
+            ev("wait_for",{"condition":cond,"name":name,"type":typ,"predicate":pred})
+            return jsonify({"status":"ok","matched":True,"condition":cond,"element":el,
+                "elapsed_ms":int((time.monotonic()-t0)*1000),"polls":polls})
+        now=time.monotonic()
+        if now>=deadline:break
+        time.sleep(min(delay,deadline-now));delay=min(max_delay,delay*1.5)
+    out={"status":"timeout","matched":False,"condition":cond,"element":None,
+        "elapsed_ms":int((time.monotonic()-t0)*1000),"polls":polls}
+    if hits is None:out["error"]="WDA query failed"
+    return jsonify(out)
+
 # Siri
 @app.route("/api/siri",methods=["POST"])
 def r_siri():
@@ -821,7 +2525,8 @@ def r_touchid():
 @app.route("/api/launch-unattached",methods=["POST"])
 def r_launch_un():
     d=request.get_json(force=True,silent=True) or {}
-    return jsonify(w("POST","/wda/apps/launchUnattached",d))
+    r=w("POST","/wda/apps/launchUnattached",d)
+    _meta_invalidate(_target(),"active_app");return jsonify(r)
 
 # Reset app auth
 @app.route("/api/reset-app-auth",methods=["POST"])
@@ -1002,6 +2707,244 @@ def r_evc():
     with ev_lock:events.clear()
     return jsonify({"status":"ok"})
 
+# ── Telemetry ────────────────────────────────────────────────────────────────
+# A background sampler records per device, every TELEMETRY_INTERVAL seconds:
+# battery level/state, thermal state, WDA round-trip time, reachability and
+# new sessions. WDA has no sessionless battery endpoint and the sampler opens
+# no sessions, so battery is only known while a device has one. Samples are
+# fixed-size binary records appended to STATE_DIR/telemetry/<ip>/raw.bin and
+# rolled up into 1m.bin and 1h.bin once each bucket is complete; every tier is
+# trimmed to its retention.
+
+TELEMETRY_INTERVAL=float(os.environ.get("TELEMETRY_INTERVAL","30"))  # seconds between samples; 0 disables
+TELEMETRY_DIR=STATE_DIR/"telemetry"
+TELE_TIERS=(("raw",0),("1m",60),("1h",3600))  # tier, bucket seconds
+TELE_RETENTION={"raw":int(os.environ.get("TELEMETRY_RAW_RETENTION",str(86400))),"1m":7*86400,"1h":365*86400}
+TELE_MAX_POINTS=1500  # "auto" resolution picks the finest tier within this many points
+# ts, battery 0-1 (NaN unknown), battery state, thermal state (255 unknown), rtt ms, max rtt ms (NaN down), share up *255, new sessions
+TELE_REC=struct.Struct("<IfBBffBH")
+TELE_FIELDS=("battery","battery_state","thermal","rtt_ms","rtt_max_ms","up","sessions")
+_tele_lock=threading.Lock()
+_sess_created={}  # ip -> sessions created by sid()
+_tele_seen={}  # ip -> _sess_created value at the last sample
+_tele_next={}  # (ip, tier) -> start of the next bucket to roll up into that tier
+
+def _tele_path(ip,tier):
+    return TELEMETRY_DIR/re.sub(r"[^A-Za-z0-9_.-]","_",ip)/f"{tier}.bin"
+
+def _tele_read(ip,tier,start=0,end=None):
+    """Records with start <= ts <= end; records are in time order, so only that range is read."""
+    try:f=open(_tele_path(ip,tier),"rb")
+    except OSError:return []
+    with f:
+        n=os.fstat(f.fileno()).st_size//TELE_REC.size  # ignore a torn last record
+        def ts(i):f.seek(i*TELE_REC.size);return struct.unpack("<I",f.read(4))[0]
+        lo,hi=0,n
+        while lo<hi:
+            mid=(lo+hi)//2
+            if ts(mid)<start:lo=mid+1
+            else:hi=mid
+        f.seek(lo*TELE_REC.size);data=f.read((n-lo)*TELE_REC.size)
+    out=[]
+    for r in TELE_REC.iter_unpack(data):
+        if end is not None and r[0]>end:break
+        out.append(r)
+    return out
+
+def _tele_edge(ip,tier,newest=True):
+    """Newest (or oldest) record of a tier, or None."""
+    try:
+        with open(_tele_path(ip,tier),"rb") as f:
+            n=os.fstat(f.fileno()).st_size//TELE_REC.size
+            if not n:return None
+            f.seek((n-1 if newest else 0)*TELE_REC.size);return TELE_REC.unpack(f.read(TELE_REC.size))
+    except OSError:return None
+
+def _tele_append(ip,tier,recs):
+    p=_tele_path(ip,tier);p.parent.mkdir(parents=True,exist_ok=True)
+    with open(p,"ab") as f:f.write(b"".join(TELE_REC.pack(*r) for r in recs))
+
+def _tele_sample(ip):
+    t0=time.monotonic()
+    r=w("GET","/status",timeout=3,ip=ip)
+    rtt=(time.monotonic()-t0)*1000
+    up=isinstance(r,dict) and isinstance(r.get("value"),dict)
+    bat,state,thermal=math.nan,255,255
+    if up:  # never via sid(): the sampler must not open (or count) sessions on phones nobody is using
+        s=SESSIONS.get(ip)
+        v=(w("GET",f"/session/{s}/wda/batteryInfo",timeout=3,ip=ip) or {}).get("value") if s else None
+        if isinstance(v,dict):
+            try:
+                bat=float(v.get("level"));bat=bat/100 if bat>1 else bat
+                state=int(v.get("state"))&255
+            except (TypeError,ValueError):pass
+        v=(w("GET","/wda/device/info",timeout=3,ip=ip) or {}).get("value")  # sessionless
+        if isinstance(v,dict) and isinstance(v.get("thermalState"),int):thermal=v["thermalState"]&255
+    with _tele_lock:
+        n=_sess_created.get(ip,0);new=n-_tele_seen.get(ip,n);_tele_seen[ip]=n
+    return (int(time.time()),bat,state,thermal,rtt if up else math.nan,rtt if up else math.nan,255 if up else 0,min(65535,new))
+
+def _tele_mean(xs):
+    xs=[x for x in xs if not math.isnan(x)]
+    return sum(xs)/len(xs) if xs else math.nan
+
+def _tele_aggregate(ts,recs):
+    known=lambda i:[r[i] for r in recs if r[i]!=255]
+    return (ts,_tele_mean([r[1] for r in recs]),(known(2) or [255])[-1],max(known(3),default=255),
+        _tele_mean([r[4] for r in recs]),max((r[5] for r in recs if not math.isnan(r[5])),default=math.nan),
+        round(sum(r[6] for r in recs)/len(recs)),min(65535,sum(r[7] for r in recs)))
+
+def _tele_rollup(ip,now):
+    """Fold complete buckets of each tier into the next coarser one; trim to retention when an hour is appended. Hold _tele_lock."""
+    for (src,_),(dst,b) in zip(TELE_TIERS,TELE_TIERS[1:]):
+        start=_tele_next.get((ip,dst))
+        if start is None:  # first look since start-up: after the newest rolled-up bucket, else the oldest source one
+            last=_tele_edge(ip,dst);first=None if last else _tele_edge(ip,src,newest=False)
+            if not last and not first:continue
+            start=last[0]+b if last else first[0]//b*b
+        done=now//b*b
+        if done<=start:_tele_next[(ip,dst)]=start;continue
+        groups={}
+        for r in _tele_read(ip,src,start,done-1):groups.setdefault(r[0]//b*b,[]).append(r)
+        _tele_next[(ip,dst)]=done
+        if not groups:continue
+        _tele_append(ip,dst,[_tele_aggregate(t,rs) for t,rs in sorted(groups.items())])
+        if dst=="1h":
+            for tier,_ in TELE_TIERS:
+                keep=_tele_read(ip,tier,now-TELE_RETENTION[tier])
+                p=_tele_path(ip,tier);tmp=p.with_suffix(".tmp")
+                tmp.write_bytes(b"".join(TELE_REC.pack(*r) for r in keep));os.replace(tmp,p)
+
+def _tele_devices():
+    with _scan_lock:ips={d["ip"] for d in SCANNED_DEVICES}
+    with _devices_lock:ips|=set(DEVICES)
+    return sorted(ips)
+
+def _tele_loop():
+    while True:
+        t0=time.monotonic();ips=_tele_devices()
+        if ips:
+            with ThreadPoolExecutor(max_workers=min(8,len(ips))) as ex:recs=list(ex.map(_shard_sample if _shards else _tele_sample,ips))
+            now=int(time.time())
+            with _tele_lock:
+                for ip,rec in zip(ips,recs):
+                    if rec is None:continue  # owning worker unreachable
+                    try:_tele_append(ip,"raw",[rec]);_tele_rollup(ip,now)
+                    except OSError as e:log.warning(f"Telemetry write failed for {ip}: {e}")
+        time.sleep(max(1.0,TELEMETRY_INTERVAL-(time.monotonic()-t0)))
+
+def _tele_json(v,i):
+    if i in (1,4,5):return None if math.isnan(v) else round(v,4 if i==1 else 1)
+    if i in (2,3):return None if v==255 else v
+    if i==6:return round(v/255,3)
+    return v
+
+def _tele_summary(ip,now):
+    """Latest sample and last-hour figures for one device."""
+    hour=_tele_read(ip,"raw",now-3600)
+    if not hour:return None
+    last=hour[-1];bats=[(r[0],r[1]) for r in hour if not math.isnan(r[1])]
+    drain=None
+    if len(bats)>1 and bats[-1][0]>bats[0][0]:drain=round((bats[0][1]-bats[-1][1])*100*3600/(bats[-1][0]-bats[0][0]),2)
+    day=_tele_read(ip,"1m",now-86400)
+    return {"latest":{"ts":last[0],**{f:_tele_json(last[i+1],i+1) for i,f in enumerate(TELE_FIELDS)}},
+        "hour":{"rtt_ms":_tele_json(_tele_mean([r[4] for r in hour]),4),"up":round(sum(r[6] for r in hour)/len(hour)/255,3),
+            "battery_drain_pct_per_h":drain,"max_thermal":_tele_json(max((r[3] for r in hour if r[3]!=255),default=255),3),
+            "sessions":sum(r[7] for r in hour)},
+        "day_rtt_ms":_tele_json(_tele_mean([r[4] for r in day]),4) if day else None}
+
+@app.route("/api/telemetry")
+def r_telemetry():
+    """?device=&from=&to= (unix s, default the last hour) &resolution=auto|raw|1m|1h. Without device: a summary per device.
+    Battery is null for samples taken while the device had no WDA session (WDA only reports it inside one)."""
+    now=int(time.time());ip=(request.args.get("device") or "").strip()
+    if not ip:
+        with _tele_lock:
+            ips=sorted(p.name for p in TELEMETRY_DIR.iterdir() if p.is_dir()) if TELEMETRY_DIR.is_dir() else []
+            out={}
+            for d in ips:
+                s=_tele_summary(d,now)
+                if s:out[d]=s
+        return jsonify({"devices":out,"interval":TELEMETRY_INTERVAL})
+    try:
+        end=int(float(request.args.get("to",now)));start=int(float(request.args.get("from",end-3600)))
+    except ValueError:return jsonify({"error":"Invalid from/to"}),400
+    res=request.args.get("resolution","auto")
+    if res=="auto":
+        span=max(1,end-start)
+        res=next((t for t,b in TELE_TIERS if now-TELE_RETENTION[t]<=start and span/(b or max(1.0,TELEMETRY_INTERVAL))<=TELE_MAX_POINTS),"1h")
+    if res not in TELE_RETENTION:return jsonify({"error":"resolution must be auto, raw, 1m or 1h"}),400
+    with _tele_lock:recs=_tele_read(ip,res,start,end)
+    cols={"t":[r[0] for r in recs]}
+    for i,f in enumerate(TELE_FIELDS,1):cols[f]=[_tele_json(r[i],i) for r in recs]
+    return jsonify({"device":ip,"resolution":res,"from":start,"to":end,"count":len(recs),**cols})
+
+# ── Response compression ─────────────────────────────────────────────────────
+# Large JSON/text bodies are compressed per Accept-Encoding (zstd or brotli
+# when installed, else gzip). Bodies are compressed chunk by chunk as they are
+# sent, so a large payload is never held compressed and uncompressed at once.
+
+try:import brotli
+except ImportError:brotli=None
+try:import zstandard
+except ImportError:zstandard=None
+
+COMPRESS_MIN_SIZE=int(os.environ.get("COMPRESS_MIN_SIZE","1024"))  # bytes; smaller bodies go out as-is
+COMPRESS_LEVEL=int(os.environ.get("COMPRESS_LEVEL","6"))  # gzip 1-9 (brotli/zstd use the same number)
+COMPRESS_TYPES=("application/json","application/xml","application/javascript","text/","image/svg+xml")
+COMPRESS_CHUNK=64*1024
+
+def _encoders():
+    out={"gzip":lambda:zlib.compressobj(COMPRESS_LEVEL,zlib.DEFLATED,31)}
+    if brotli:out["br"]=lambda:_BrotliStream(brotli.Compressor(quality=min(11,COMPRESS_LEVEL)))
+    if zstandard:out["zstd"]=lambda:zstandard.ZstdCompressor(level=COMPRESS_LEVEL).compressobj()
+    return out
+
+class _BrotliStream:
+    """brotli.Compressor with the compress()/flush() interface of zlib and zstandard."""
+    def __init__(self,c):self.c=c
+    def compress(self,b):return self.c.process(b)
+    def flush(self):return self.c.finish()
+
+_ENCODERS=_encoders()
+
+def _negotiate(accept):
+    """Best supported coding from an Accept-Encoding header (server preference zstd > br > gzip)."""
+    q={}
+    for part in accept.split(","):
+        name,_,params=part.strip().partition(";")
+        m=re.search(r"q=([\d.]+)",params)
+        try:q[name.strip().lower()]=float(m.group(1)) if m else 1.0
+        except ValueError:continue
+    for enc in ("zstd","br","gzip"):
+        if enc in _ENCODERS and q.get(enc,q.get("*",0))>0:return enc
+    return None
+
+def _compressed(chunks,enc):
+    c=_ENCODERS[enc]()
+    try:
+        for chunk in chunks:
+            mv=memoryview(chunk.encode() if isinstance(chunk,str) else chunk)
+            for i in range(0,len(mv),COMPRESS_CHUNK):
+                out=c.compress(mv[i:i+COMPRESS_CHUNK])
+                if out:yield out
+        yield c.flush()
+    finally:
+        if hasattr(chunks,"close"):chunks.close()
+
+@app.after_request
+def _compress(resp):
+    if request.method=="HEAD" or resp.status_code<200 or resp.status_code in (204,304):return resp
+    if "Content-Encoding" in resp.headers or resp.mimetype=="text/event-stream" or not resp.mimetype.startswith(COMPRESS_TYPES):return resp
+    resp.vary.add("Accept-Encoding")
+    enc=_negotiate(request.headers.get("Accept-Encoding",""))
+    if not enc:return resp
+    size=resp.headers.get("Content-Length",type=int) if resp.is_streamed else resp.calculate_content_length()
+    if size is not None and size<COMPRESS_MIN_SIZE:return resp
+    resp.response=_compressed(resp.response,enc);resp.direct_passthrough=True
+    resp.headers["Content-Encoding"]=enc;resp.headers.pop("Content-Length",None)
+    return resp
+
 # ── Dashboard ─────────────────────────────────────────────────────────────────
 
 @app.route("/")
@@ -1021,7 +2964,13 @@ if __name__=="__main__":
     pa=argparse.ArgumentParser()
     pa.add_argument("--ip",default=None,help="Default device IP (or set env IP)")
     pa.add_argument("--port",type=int,default=int(os.environ.get("PORT","5050")),help="Bridge port (default 5050, or env PORT)")
+    pa.add_argument("--workers",default=os.environ.get("WORKERS","1"),help="Worker processes devices are sharded across (default 1 = no sharding; 'auto' = one per CPU; or env WORKERS)")
+    pa.add_argument("--worker",type=int,default=None,help=argparse.SUPPRESS)  # internal: run as shard worker N
     a=pa.parse_args()
+    if a.worker is not None:
+        _shard_worker(a.worker,a.port);raise SystemExit
+    try:n_workers=(os.cpu_count() or 1) if a.workers=="auto" else max(1,int(a.workers))
+    except ValueError:pa.error("--workers must be a number or 'auto'")
     IPHONE_IP=(os.environ.get("IP","").strip() or None)
     if a.ip:IPHONE_IP=a.ip
     env_devices=[x.strip() for x in os.environ.get("DEVICES","").split(",") if x.strip()]
@@ -1036,20 +2985,22 @@ if __name__=="__main__":
     log.info("UDITA")
     log.info("="*50)
     log.info(f"Devices (manual): {DEVICES}")
-    # Start continuous subnet scan (WDA on :8100)
+    # Known devices are listed right away and revalidated in the background
+    _inv_load()
+    if n_workers>1:_shard_start(n_workers,a.port)  # first: from here on only workers open WDA sessions
+    _warm_start()
+    threading.Thread(target=_inv_flusher,daemon=True).start()
+    atexit.register(_inv_save)
+    _lease_load();_tpl_load()
+    threading.Thread(target=_lease_reaper,daemon=True).start()
+    threading.Thread(target=_meta_refresher,daemon=True).start()
+    if TELEMETRY_INTERVAL>0:threading.Thread(target=_tele_loop,daemon=True).start()
+    atexit.register(_lease_save)
+    # Discovery: ARP/neighbor table + mDNS, full subnet scan as slow fallback (WDA on :8100)
     t=threading.Thread(target=_scanner_loop,daemon=True)
     t.start()
-    log.info("Network scan running (every %ss)"%SCAN_INTERVAL)
-    if wda_ready():
-        log.info("WDA: CONNECTED")
-        try:
-            r=w("GET","/status",timeout=3)
-            ip=(r.get("value") or {}).get("ios",{}).get("ip")
-            if ip:IPHONE_IP=ip
-        except:pass
-        DW,DH=wda_size();log.info(f"Screen: {DW}x{DH}");sid()
-    else:
-        log.warning("WDA not reachable")
+    if MDNS:threading.Thread(target=_mdns_listener,daemon=True).start()
+    log.info("Discovery running (neighbors every %ss, full scan every %ss)"%(NEIGHBOR_INTERVAL,FULL_SCAN_INTERVAL))
     log.info(f"\nDashboard: http://localhost:{a.port}\n")
 
     # Reload dashboard on each request (for dev)
@@ -0,0 +1,6 @@
+import os,sys,tempfile
+from pathlib import Path
+
+# server.py reads its state directory at import time; keep tests away from ~/.udita
+os.environ.setdefault("UDITA_STATE_DIR",tempfile.mkdtemp(prefix="udita-test-"))
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,38 @@
+import pytest
+from flask import Response
+import server
+
+IP="10.0.0.7"
+
+@pytest.fixture
+def client(monkeypatch):
+    closed=[]
+    def body():
+        try:yield b"chunk";yield b"chunk"
+        finally:closed.append(True)
+    monkeypatch.setitem(server.app.view_functions,"r_screeninfo",lambda:Response(body(),mimetype="application/octet-stream"))
+    monkeypatch.setattr(server,"_adm",{})
+    monkeypatch.setattr(server,"_shards",[])
+    with server.app.test_client() as c:yield c
+
+def active():
+    return sum(server._adm[IP]["active"].values())
+
+def test_stream_holds_slot_until_sent(client):
+    r=client.get(f"/api/screen-info?device={IP}",buffered=False)
+    assert active()==1
+    assert r.get_data()==b"chunkchunk"
+    r.close()
+    assert active()==0
+
+@pytest.mark.parametrize("method",["GET","HEAD"])
+def test_unread_stream_frees_slot_on_close(client,method):
+    r=client.open(f"/api/screen-info?device={IP}",method=method,buffered=False)
+    r.close()
+    assert active()==0
+
+def test_repeated_heads_do_not_exhaust_slots(client):
+    for _ in range(server.ADMIT_DEVICE*3):
+        client.head(f"/api/screen-info?device={IP}").close()
+    assert active()==0
+    assert client.get(f"/api/screen-info?device={IP}").status_code==200
@@ -0,0 +1,14 @@
+import pytest
+import server
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(server,"_jobs",{})
+    monkeypatch.setattr(server,"_shards",[])
+    with server.app.test_client() as c:yield c
+
+@pytest.mark.parametrize("method,path,code",[("POST","/api/no-such-route",404),("DELETE","/api/tap",405)])
+def test_async_request_to_unknown_route_is_refused_up_front(client,method,path,code):
+    r=client.open(f"{path}?async=1&device=10.0.0.1",method=method)
+    assert r.status_code==code and "error" in r.get_json()
+    assert server._jobs=={}
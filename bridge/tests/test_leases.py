@@ -0,0 +1,61 @@
+import itertools
+import pytest
+import server
+
+def info(version,device="iphone"):
+    return {"device_info":{"os":{"name":"iOS","version":version},"device":device},"screen":{"width":393,"height":852}}
+
+@pytest.fixture
+def fleet(monkeypatch):
+    inv={"10.0.0.1":dict(info("17.2"),ip="10.0.0.1"),"10.0.0.2":dict(info("16.7.1"),ip="10.0.0.2"),
+        "10.0.0.3":dict(info("17.0","ipad"),ip="10.0.0.3")}
+    monkeypatch.setattr(server,"_inventory",inv)
+    monkeypatch.setattr(server,"DEVICES",list(inv))
+    monkeypatch.setattr(server,"SCANNED_DEVICES",[])
+    monkeypatch.setattr(server,"_health",{})
+    monkeypatch.setattr(server,"_leases",{})
+    monkeypatch.setattr(server,"_lease_jobs",{})
+    monkeypatch.setattr(server,"_lease_seq",itertools.count())
+    monkeypatch.setattr(server,"_lease_dirty",False)
+    return inv
+
+@pytest.mark.parametrize("caps,expected",[
+    ({},{"10.0.0.1","10.0.0.2","10.0.0.3"}),
+    ({"ios":"17"},{"10.0.0.1","10.0.0.3"}),
+    ({"ios":"17.2"},{"10.0.0.1"}),
+    ({"min_ios":"17.1"},{"10.0.0.1"}),
+    ({"max_ios":"16"},{"10.0.0.2"}),
+    ({"max_ios":"17.0"},{"10.0.0.2","10.0.0.3"}),
+    ({"device":"iPad"},{"10.0.0.3"}),
+    ({"ip":"10.0.0.2"},{"10.0.0.2"}),
+    ({"width":393,"ios":"16"},{"10.0.0.2"}),
+    ({"height":1000},set()),
+])
+def test_caps_match(fleet,caps,expected):
+    assert {ip for ip in fleet if server._caps_match(ip,caps)}==expected
+
+def test_caps_match_unknown_device_only_matches_without_version_caps(fleet):
+    assert server._caps_match("10.9.9.9",{})
+    assert not server._caps_match("10.9.9.9",{"ios":"17"})
+
+def job(jid,caps=None,priority=0):
+    j={"id":jid,"caps":caps or {},"priority":priority,"client":jid,"ttl":60,"seq":next(server._lease_seq),
+        "enqueued":0,"expires":1e12,"state":"queued","lease":None}
+    server._lease_jobs[jid]=j
+    return j
+
+def test_schedule_priority_then_fifo_with_backfill(fleet):
+    a=job("a",{"ios":"17.2"})
+    b=job("b",{"ios":"17.2"},priority=5)  # same device, higher priority: wins
+    c=job("c",{"ios":"16"})  # later, but another device is free: backfills
+    with server._lease_cond:server._lease_schedule()
+    assert b["state"]=="granted" and a["state"]=="queued" and c["state"]=="granted"
+    assert server._leases[b["lease"]]["ip"]=="10.0.0.1" and server._leases[c["lease"]]["ip"]=="10.0.0.2"
+
+def test_schedule_skips_leased_and_open_breaker_devices(fleet,monkeypatch):
+    server._leases["x"]={"id":"x","ip":"10.0.0.1"}
+    monkeypatch.setitem(server._health,"10.0.0.3",{"state":"open"})
+    j1=job("j1");j2=job("j2")
+    with server._lease_cond:server._lease_schedule()
+    assert j1["state"]=="granted" and server._leases[j1["lease"]]["ip"]=="10.0.0.2"
+    assert j2["state"]=="queued"
@@ -0,0 +1,39 @@
+import pytest
+import server
+
+IP="10.0.0.5"
+
+@pytest.fixture
+def meta(monkeypatch):
+    for name,v in (("_meta",{}),("_meta_read",{}),("_meta_inflight",set()),("_meta_gen",{})):
+        monkeypatch.setattr(server,name,v)
+    monkeypatch.setattr(server,"_meta_stats",{"hits":0,"misses":0,"refreshes":0})
+    return monkeypatch
+
+def test_cached_until_invalidated(meta):
+    calls=[]
+    meta.setitem(server.META_FETCH,"orientation",lambda ip:calls.append(ip) or {"value":"PORTRAIT"})
+    assert server._meta_get("orientation",IP)==server._meta_get("orientation",IP)=={"value":"PORTRAIT"}
+    server._meta_invalidate(IP,"orientation")
+    server._meta_get("orientation",IP)
+    assert len(calls)==2
+
+def test_fetch_spanning_invalidation_is_not_cached(meta):
+    def fetch(ip):
+        server._meta_invalidate(ip,"orientation")  # device rotated while the old value was on its way
+        return {"value":"PORTRAIT"}
+    meta.setitem(server.META_FETCH,"orientation",fetch)
+    assert server._meta_get("orientation",IP)=={"value":"PORTRAIT"}
+    assert "orientation" not in server._meta.get(IP,{})
+
+def test_invalidate_all_fields(meta):
+    meta.setitem(server.META_FETCH,"battery",lambda ip:{"value":{"level":0.5}})
+    server._meta_get("battery",IP)
+    server._meta_invalidate(IP)
+    assert server._meta[IP]=={} and server._meta_gen[(IP,"battery")]==1
+
+def test_callers_cannot_change_the_cached_value(meta):
+    meta.setitem(server.META_FETCH,"battery",lambda ip:{"value":{"level":0.5}})
+    server._meta_get("battery",IP)["extra"]=1
+    server._meta_get("battery",IP)["extra"]=2
+    assert server._meta_get("battery",IP)=={"value":{"level":0.5}}
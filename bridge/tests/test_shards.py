@@ -0,0 +1,61 @@
+import math
+import pytest
+import server
+
+IPS=[f"10.0.{i//200}.{i%200+1}" for i in range(100)]
+
+def worker(i,alive=True):
+    return {"i":i,"alive":alive,"vnodes":[(server._hash(f"w{i}#{v}"),i) for v in range(server.SHARD_VNODES)]}
+
+@pytest.fixture
+def ring(monkeypatch):
+    monkeypatch.setattr(server,"_shards",[worker(i) for i in range(4)])
+    monkeypatch.setattr(server,"_assign",{})
+    monkeypatch.setattr(server,"DEVICES",list(IPS))
+    monkeypatch.setattr(server,"SCANNED_DEVICES",[])
+    monkeypatch.setattr(server,"IPHONE_IP",None)
+    return server._shards
+
+def loads():
+    out={}
+    for i in server._assign.values():out[i]=out.get(i,0)+1
+    return out
+
+def test_every_device_placed_within_bounded_load(ring):
+    server._shard_rebalance()
+    assert set(server._assign)==set(IPS)
+    assert max(loads().values())<=math.ceil(server.SHARD_LOAD*len(IPS)/4)
+
+def test_new_device_moves_nothing_else(ring):
+    server._shard_rebalance();before=dict(server._assign)
+    server._shard_rebalance(("10.9.9.9",))
+    assert {ip:i for ip,i in server._assign.items() if ip in before}==before and "10.9.9.9" in server._assign
+
+def test_dead_worker_only_moves_its_own_devices(ring):
+    server._shard_rebalance();before=dict(server._assign)
+    ring[2]["alive"]=False
+    server._shard_rebalance()
+    assert 2 not in loads()
+    assert all(server._assign[ip]==i for ip,i in before.items() if i!=2)
+    assert max(loads().values())<=math.ceil(server.SHARD_LOAD*len(IPS)/3)
+
+def test_placements_kept_while_no_worker_is_alive(ring):
+    server._shard_rebalance();before=dict(server._assign)
+    for s in ring:s["alive"]=False
+    server._shard_rebalance(("10.9.9.9",))
+    assert server._assign==before
+
+def test_owner_places_unknown_device(ring):
+    s=server._shard_owner("10.9.9.9")
+    assert s is not None and server._assign["10.9.9.9"]==s["i"]
+
+def test_worker_reports_inventory_changes(monkeypatch):
+    monkeypatch.setattr(server,"SHARD",0)
+    monkeypatch.setattr(server,"_inventory",{})
+    monkeypatch.setattr(server,"_inv_report",{})
+    server._inv_update("10.0.0.1",session="S1")
+    server._inv_update("10.0.0.1",screen={"width":393,"height":852})
+    server._inv_update("10.0.0.1",session="S1")  # unchanged: not reported again
+    with server.app.test_client() as c:
+        assert c.get("/api/shard/inventory").get_json()=={"devices":{"10.0.0.1":{"session":"S1","screen":{"width":393,"height":852}}}}
+        assert c.get("/api/shard/inventory").get_json()=={"devices":{}}
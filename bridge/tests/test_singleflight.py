@@ -0,0 +1,24 @@
+import threading
+import time
+import server
+
+def test_waiters_get_their_own_copy(monkeypatch):
+    started,release=threading.Event(),threading.Event()
+    calls=[]
+    def upstream(method,path,timeout=None,ip=None):
+        calls.append(path);started.set();release.wait(5)
+        return {"value":"<xml/>"}
+    monkeypatch.setattr(server,"w",upstream)
+    monkeypatch.setattr(server,"_flights",{})
+    monkeypatch.setattr(server,"_flight_stats",{})
+    out=[]
+    leader=threading.Thread(target=lambda:out.append(server._single_flight("10.0.0.1","/source",None)))
+    leader.start();started.wait(5)
+    waiter=threading.Thread(target=lambda:out.append(server._single_flight("10.0.0.1","/source",None)))
+    waiter.start()
+    end=time.monotonic()+5
+    while not server._flight_stats["internal"]["collapsed"] and time.monotonic()<end:time.sleep(0.001)
+    release.set();leader.join();waiter.join()
+    assert calls==["/source"] and out[0]==out[1]=={"value":"<xml/>"} and out[0] is not out[1]
+    out[0]["device"]="10.0.0.1"
+    assert "device" not in out[1]
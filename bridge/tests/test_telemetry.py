@@ -0,0 +1,64 @@
+import math
+import pytest
+import server
+
+NAN=math.nan
+
+def rec(ts,battery=0.5,state=2,thermal=1,rtt=10.0,up=255,sessions=0):
+    return (ts,battery,state,thermal,rtt,rtt if up else NAN,up,sessions)
+
+@pytest.fixture
+def tele(tmp_path,monkeypatch):
+    monkeypatch.setattr(server,"TELEMETRY_DIR",tmp_path)
+    monkeypatch.setattr(server,"_tele_next",{})
+    return tmp_path
+
+def test_aggregate_means_maxima_and_unknowns():
+    recs=[rec(0,battery=0.6,state=2,thermal=1,rtt=10.0),rec(30,battery=NAN,state=255,thermal=3,rtt=30.0),
+        rec(45,battery=0.4,state=3,thermal=255,rtt=NAN,up=0,sessions=2)]
+    ts,bat,state,thermal,rtt,rtt_max,up,sessions=server._tele_aggregate(0,recs)
+    assert ts==0 and bat==pytest.approx(0.5)
+    assert state==3  # last known
+    assert thermal==3  # worst known
+    assert rtt==pytest.approx(20.0) and rtt_max==pytest.approx(30.0)
+    assert up==170 and sessions==2
+
+def test_aggregate_all_unknown():
+    r=server._tele_aggregate(60,[rec(60,battery=NAN,state=255,thermal=255,rtt=NAN,up=0)])
+    assert math.isnan(r[1]) and r[2]==255 and r[3]==255 and math.isnan(r[4]) and math.isnan(r[5]) and r[6]==0
+
+def test_read_range(tele):
+    server._tele_append("d","raw",[rec(t) for t in range(0,600,30)])
+    assert [r[0] for r in server._tele_read("d","raw",95,200)]==[120,150,180]
+    assert len(server._tele_read("d","raw"))==20
+    assert server._tele_read("d","raw",10_000)==[]
+    assert server._tele_read("missing","raw")==[]
+
+def test_rollup_buckets_and_trims_once_per_hour(tele,monkeypatch):
+    trims=[]
+    real=server.os.replace
+    monkeypatch.setattr(server.os,"replace",lambda a,b:(trims.append(b),real(a,b)))
+    t0=1_700_000_000//3600*3600
+    for t in range(t0,t0+3*3600,30):
+        server._tele_append("d","raw",[rec(t)])
+        server._tele_rollup("d",t+1)
+    assert len(trims)==2*len(server.TELE_TIERS)  # hours 1 and 2 have rolled; the third is still open
+    m=server._tele_read("d","1m")
+    assert [r[0] for r in m]==list(range(t0,t0+3*3600-60,60))
+    assert [r[0] for r in server._tele_read("d","1h")]==[t0,t0+3600]
+
+def test_rollup_resumes_after_restart_without_duplicates(tele):
+    t0=1_700_000_000//3600*3600
+    for t in range(t0,t0+600,30):server._tele_append("d","raw",[rec(t)])
+    server._tele_rollup("d",t0+300)
+    server._tele_next.clear()  # as after a restart
+    server._tele_rollup("d",t0+600)
+    assert [r[0] for r in server._tele_read("d","1m")]==list(range(t0,t0+600,60))
+
+def test_rollup_trims_to_retention(tele,monkeypatch):
+    monkeypatch.setitem(server.TELE_RETENTION,"raw",3600)
+    t0=1_700_000_000//3600*3600
+    for t in range(t0,t0+2*3600,60):server._tele_append("d","raw",[rec(t)])
+    server._tele_rollup("d",t0+2*3600)
+    assert server._tele_read("d","raw")[0][0]>=t0+3600
+    assert len(server._tele_read("d","1h"))==2